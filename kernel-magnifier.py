@@ -1,22 +1,60 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
+import contextlib
+import resource
+import bisect
+import json
+import struct
+import glob
+import zlib
+import gzip
+import lzma
+import queue
+import heapq
+import math
+import mmap
+import shutil
 import time
 import os
 import sys
 import re
-import pygraphviz as pgv
 from dataclasses import dataclass
 import types
 import subprocess
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
-from matplotlib.ticker import ScalarFormatter
-import numpy as np
+import multiprocessing
+import threading
+import select
+import signal
+import fcntl
+# pygraphviz, matplotlib and numpy are imported on first use: record, live
+# and generate-symbol-map run on a bare Python standard library. The same
+# goes for http.server and urllib.parse, just used by serve
 
 
 FTRACE_DIR = "/sys/kernel/tracing/"
 RECORD_OUT_FILE = "kernel-magnifier.data"
+RECORD_META_FILE = "kernel-magnifier.meta"
+RAW_SYMBOL_FILE = "kernel-magnifier.kallsyms"
+RAW_CPU_FILE = "kernel-magnifier-cpu{}.raw"
+TEXT_CPU_FILE = "kernel-magnifier-cpu{}.data"
+CACHE_FILE = "kernel-magnifier.cache"
+CACHE_VERSION = 3
+AGGREGATE_FILE = "kernel-magnifier.aggregate"
+# written by aggregate and merge, never picked up instead of the recording
+EXPORT_AGGREGATE_FILE = "kernel-magnifier-export.aggregate"
+MERGED_AGGREGATE_FILE = "kernel-magnifier-merged.aggregate"
+AGGREGATE_VERSION = 1
+RECORD_GRAPH_FILE = "kernel-magnifier.graph"
+STACKS_FILE = "kernel-magnifier.folded"
+
+# ring buffer event types, see include/linux/ring_buffer.h
+RB_TYPE_PADDING = 29
+RB_TYPE_TIME_EXTEND = 30
+RB_TYPE_TIME_STAMP = 31
+RB_MISSED_EVENTS = 1 << 31
+RB_MISSED_STORED = 1 << 30
 
 
 @dataclass
@@ -28,119 +66,392 @@ class FunctionTracerData:
     parent: str
 
 
-class Node(object):
-    def __init__(self, name, map_db):
-        self.name = name
-        self.filepath = None
-        if map_db and name in map_db.symbol:
-            self.filepath = map_db.symbol[name]
-
-
-    def label(self, executed=0):
-        if self.filepath:
-            return f"{self.name}()\n{self.filepath}\nExecuted: {executed}"
-        return f"{self.name}()\nExecuted: {executed}"
-
-    def __eq__(self, other):
-        if isinstance(other, Node):
-            return self.name == other.name
-        return False
-
-    def __hash__(self):
-        return hash(self.name)
-
-
-class Edge(object):
-    def __init__(self):
-        self.calls = 0
-
-    def update(self):
-        self.calls += 1
+# edges are stored as one packed integer: caller_id << EDGE_SHIFT | called_id
+EDGE_SHIFT = 32
+EDGE_MASK = (1 << EDGE_SHIFT) - 1
 
 
 class Network(object):
     def __init__(self):
-        self.adjacency = dict()
-        self.clusters = list()
+        # functions are interned once, afterwards everything is keyed by id
+        self.ids = dict()
+        self.names = list()
+        self.filepaths = list()
+        self.node_calls = list()
+        self.edges = dict()
+        # sparse per task aggregate: (task, pid, cpu, edge) -> calls
+        self.task_calls = dict()
+        # connected components as disjoint-set forest over function ids
+        self.cluster_parent = list()
+        self.cluster_size = list()
+        self.verdicts_key = None
         self.calls_max = 0
-        self.node_calls = dict()
         self.executed_max = 0
-
-    def add(self, calling_function_name, called_function_name, map_db):
-        calling_node = Node(calling_function_name, map_db)
-        if not calling_node in self.adjacency:
-            self.adjacency[calling_node] = dict()
-        called_node = Node(called_function_name, map_db)
-        if called_node not in self.adjacency[calling_node]:
-            self.adjacency[calling_node][called_node] = Edge()
-        self.adjacency[calling_node][called_node].update()
-        if self.adjacency[calling_node][called_node].calls > self.calls_max:
-            self.calls_max = self.adjacency[calling_node][called_node].calls
-        self._update_call_graph_cluster(calling_function_name, called_function_name)
-
+        # functions x windows call counts, see set_windows()
+        self.window_calls = None
+        self.window_first = 0
+        # counts are extrapolated from a sampled recording, see scale()
+        self.scale_factor = None
+
+    def intern(self, function_name, map_db):
+        function_id = self.ids.get(function_name)
+        if function_id is None:
+            function_id = len(self.names)
+            self.ids[function_name] = function_id
+            self.names.append(function_name)
+            self.filepaths.append(map_db.symbol.get(function_name) if map_db else None)
+            self.node_calls.append(0)
+            self.cluster_parent.append(function_id)
+            self.cluster_size.append(1)
+        return function_id
+
+    def add(self, calling_function_name, called_function_name, map_db, calls=1):
+        calling_id = self.intern(calling_function_name, map_db)
+        called_id = self.intern(called_function_name, map_db)
+        self.add_edge(calling_id, called_id, calls)
+        self.add_node_calls(called_id, calls)
+
+    def add_edge(self, calling_id, called_id, calls):
+        edge = calling_id << EDGE_SHIFT | called_id
+        edge_calls = self.edges.get(edge, 0) + calls
+        self.edges[edge] = edge_calls
+        if edge_calls > self.calls_max:
+            self.calls_max = edge_calls
+        self._update_call_graph_cluster(calling_id, called_id)
+
+    def add_task_calls(self, result, map_db):
+        # the per task view of calls already added by add(), from a parse
+        # result: task_calls keyed by task << 32 | call, indices into
+        # result.tasks [(task, pid, cpu)] and result.calls [(caller, called)]
+        if not result.task_calls:
+            return
+        edges = [self.intern(caller, map_db) << EDGE_SHIFT | self.intern(called, map_db)
+                 for caller, called in result.calls]
+        for key, calls in result.task_calls.items():
+            key = result.tasks[key >> 32] + (edges[key & 0xFFFFFFFF],)
+            self.task_calls[key] = self.task_calls.get(key, 0) + calls
+
+    def add_node_calls(self, function_id, calls):
         # statistics stuff
-        if called_function_name not in self.node_calls:
-            self.node_calls[called_function_name] = 0
-        self.node_calls[called_function_name] += 1
-        if self.node_calls[called_function_name] > self.executed_max:
-            self.executed_max = self.node_calls[called_function_name]
+        self.node_calls[function_id] += calls
+        if self.node_calls[function_id] > self.executed_max:
+            self.executed_max = self.node_calls[function_id]
+
+    def aggregate(self):
+        # plain, serializable representation: interned names, flat
+        # [caller_id, called_id, calls, ...] edge list and node counts
+        edges = []
+        for edge, calls in self.edges.items():
+            edges += (edge >> EDGE_SHIFT, edge & EDGE_MASK, calls)
+        # [task_no, pid, cpu, caller_id, called_id, calls, ...]
+        tasks = dict()
+        task_calls = []
+        for (task, pid, cpu, edge), calls in self.task_calls.items():
+            task_no = tasks.setdefault(task, len(tasks))
+            task_calls += (task_no, pid, cpu, edge >> EDGE_SHIFT, edge & EDGE_MASK, calls)
+        return {"names": self.names, "edges": edges, "node_calls": self.node_calls,
+                "tasks": list(tasks), "task_calls": task_calls}
+
+    def load_aggregate(self, aggregate, map_db, sign=1):
+        # counts are added, loading several aggregates sums them up. With
+        # sign -1 they are subtracted instead
+        ids = [self.intern(name, map_db) for name in aggregate["names"]]
+        edges = aggregate["edges"]
+        for i in range(0, len(edges), 3):
+            self.add_edge(ids[edges[i]], ids[edges[i + 1]], sign * edges[i + 2])
+        for function_id, calls in zip(ids, aggregate["node_calls"]):
+            if calls:
+                self.add_node_calls(function_id, sign * calls)
+        # not available for function profiles
+        tasks = aggregate.get("tasks", [])
+        task_calls = aggregate.get("task_calls", [])
+        for i in range(0, len(task_calls), 6):
+            key = (tasks[task_calls[i]], task_calls[i + 1], task_calls[i + 2],
+                   ids[task_calls[i + 3]] << EDGE_SHIFT | ids[task_calls[i + 4]])
+            self.task_calls[key] = self.task_calls.get(key, 0) + sign * task_calls[i + 5]
+
+    def keep_increases(self):
+        # after subtracting aggregates just the calls and functions which
+        # became more frequent are kept, with their increase as count
+        edges = {edge: calls for edge, calls in self.edges.items() if calls > 0}
+        self.task_calls = {key: calls for key, calls in self.task_calls.items() if calls > 0}
+        node_calls = [max(calls, 0) for calls in self.node_calls]
+        self.edges = dict()
+        self.node_calls = [0] * len(self.names)
+        self.cluster_parent = list(range(len(self.names)))
+        self.cluster_size = [1] * len(self.names)
+        self.calls_max = 0
+        self.executed_max = 0
+        for edge, calls in edges.items():
+            self.add_edge(edge >> EDGE_SHIFT, edge & EDGE_MASK, calls)
+        for function_id, calls in enumerate(node_calls):
+            self.add_node_calls(function_id, calls)
+
+    def select_tasks(self, tasks, pids, cpus):
+        # restricts the call graph to the calls of the given tasks, pids
+        # and cpus, returns the number of selected calls
+        edges = dict()
+        for (task, pid, cpu, edge), calls in self.task_calls.items():
+            if (tasks and task not in tasks) or (pids and pid not in pids) or (cpus and cpu not in cpus):
+                continue
+            edges[edge] = edges.get(edge, 0) + calls
+        self.edges = dict()
+        self.node_calls = [0] * len(self.names)
+        self.cluster_parent = list(range(len(self.names)))
+        self.cluster_size = [1] * len(self.names)
+        self.calls_max = 0
+        self.executed_max = 0
+        for edge, calls in edges.items():
+            self.add_edge(edge >> EDGE_SHIFT, edge & EDGE_MASK, calls)
+            self.add_node_calls(edge & EDGE_MASK, calls)
+        return sum(edges.values())
+
+    def set_windows(self, windows):
+        # {(window, function_id): calls} into a functions x windows matrix,
+        # columns start at the first window seen
+        if not windows:
+            return
+        import numpy as np
+        self.window_first = min(window for window, _ in windows)
+        last = max(window for window, _ in windows)
+        self.window_calls = np.zeros((len(self.names), last - self.window_first + 1), dtype=np.int64)
+        for (window, function_id), calls in windows.items():
+            self.window_calls[function_id, window - self.window_first] += calls
+
+    def scale(self, factor):
+        # sampled counts into estimates for the whole observation time
+        self.scale_factor = factor
+        self.node_calls = [round(calls * factor) for calls in self.node_calls]
+        self.edges = {edge: round(calls * factor) for edge, calls in self.edges.items()}
+        self.task_calls = {key: round(calls * factor) for key, calls in self.task_calls.items()}
+        self.calls_max = max(self.edges.values(), default=0)
+        self.executed_max = max(self.node_calls, default=0)
+        if self.window_calls is not None:
+            self.window_calls = (self.window_calls * factor).round().astype(self.window_calls.dtype)
+
+    def scale_error(self, estimate):
+        # 95% bound of an estimate, the sampled count n is taken as
+        # Poisson distributed: 1.96 * sqrt(n) * factor
+        return round(1.96 * math.sqrt(estimate * self.scale_factor))
+
+    def executed_no(self, function_id):
+        return self.node_calls[function_id]
+
+    def label(self, function_id, executed=0):
+        name = self.names[function_id]
+        filepath = self.filepaths[function_id]
+        if self.scale_factor:
+            executed = f"~{executed} ±{self.scale_error(executed)}"
+        if filepath:
+            return f"{name}()\n{filepath}\nExecuted: {executed}"
+        return f"{name}()\nExecuted: {executed}"
+
+
+    def filter_verdicts(self, args):
+        # per function id: True if the node is shown. Verdicts are computed
+        # once per distinct filepath and only extended for new ids afterwards
+        key = (tuple(args.filter_filepath or ()), tuple(args.exclude_filepath or ()))
+        if self.verdicts_key != key:
+            self.verdicts_key = key
+            self.verdicts = list()
+            self.path_verdicts = dict()
+        include, exclude = key
+        for function_id in range(len(self.verdicts), len(self.names)):
+            filepath = self.filepaths[function_id]
+            verdict = self.path_verdicts.get(filepath)
+            if verdict is None:
+                verdict = filepath_verdict(filepath, include, exclude)
+                self.path_verdicts[filepath] = verdict
+            self.verdicts.append(verdict)
+        return self.verdicts
+
+
+    def is_filepath_filtered(self, args, function_id):
+        # if true, the node is NOT shown
+        return not self.filter_verdicts(args)[function_id]
 
-    def executed_no(self, function_name):
-        if function_name not in self.node_calls:
-            return 0
-        return self.node_calls[function_name]
 
+    def subgraph(self, args, filter_calls=0):
+        # nodes and calls to show, in a single pass over all edges. Nodes
+        # require caller and called function to be shown, calls just one
+        shown = self.filter_verdicts(args)
+        component_root = self.component_filter_root(args)
+        nodes = set()
+        calls = list()
+        for edge, edge_calls in self.edges.items():
+            if edge_calls <= filter_calls:
+                continue
+            caller_id = edge >> EDGE_SHIFT
+            called_id = edge & EDGE_MASK
+            if component_root is not None and self.cluster_find(caller_id) != component_root:
+                continue
+            caller_shown = shown[caller_id]
+            called_shown = shown[called_id]
+            if caller_shown and called_shown:
+                nodes.add(caller_id)
+                nodes.add(called_id)
+            if caller_shown or called_shown:
+                calls.append((caller_id, called_id, edge_calls))
+        return nodes, calls
 
-    def is_filepath_filtered(self, args, node):
-        # if true, the node is NOT shown
-        if args.filter_filepath and not node.filepath:
-            return True
-        if not args.filter_filepath or not node.filepath:
-            return False
-        for filter_filepath in args.filter_filepath:
-            if filter_filepath in node.filepath:
-                return False
 
-        return True
+    def called_nodes(self, args, filter_calls=0):
+        # for aggregates without edges (function profile), based on the
+        # node counts alone
+        shown = self.filter_verdicts(args)
+        return set(function_id for function_id, calls in enumerate(self.node_calls)
+                   if calls > filter_calls and shown[function_id])
 
 
     def nodes(self, args, filter_calls=0):
-        nodes = set()
-        for caller_node, caller_data in self.adjacency.items():
-            for called_node, edge in caller_data.items():
-                if edge.calls <= filter_calls:
-                    continue
-                if self.is_filepath_filtered(args, caller_node):
-                    continue
-                if self.is_filepath_filtered(args, called_node):
-                    continue
-                nodes.add(caller_node)
-                nodes.add(called_node)
+        nodes, _ = self.subgraph(args, filter_calls)
         for node in nodes:
             yield node
 
 
     def calls(self, args, filter_calls=0):
-        for caller_node, caller_data in self.adjacency.items():
-            for called_node, edge in caller_data.items():
-                if edge.calls <= filter_calls:
-                    continue
-                if self.is_filepath_filtered(args, caller_node) and self.is_filepath_filtered(args, called_node):
-                    continue
-                yield caller_node, called_node, edge
+        _, calls = self.subgraph(args, filter_calls)
+        for call in calls:
+            yield call
+
+
+    def cluster_find(self, function_id):
+        # path halving, keeps the trees flat
+        parent = self.cluster_parent
+        while parent[function_id] != function_id:
+            parent[function_id] = parent[parent[function_id]]
+            function_id = parent[function_id]
+        return function_id
+
+
+    def components(self):
+        # connected components as lists of function ids, largest first
+        components = dict()
+        for function_id in range(len(self.names)):
+            components.setdefault(self.cluster_find(function_id), []).append(function_id)
+        return sorted(components.values(), key=len, reverse=True)
+
+
+    def component_filter_root(self, args):
+        if args.filter_component is None:
+            return None
+        components = self.components()
+        if args.filter_component >= len(components):
+            return -1
+        return self.cluster_find(components[args.filter_component][0])
+
+
+    def _update_call_graph_cluster(self, calling_function_id, called_function_id):
+        calling_root = self.cluster_find(calling_function_id)
+        called_root = self.cluster_find(called_function_id)
+        if calling_root == called_root:
+            return
+        # union by size
+        if self.cluster_size[calling_root] < self.cluster_size[called_root]:
+            calling_root, called_root = called_root, calling_root
+        self.cluster_parent[called_root] = calling_root
+        self.cluster_size[calling_root] += self.cluster_size[called_root]
 
+GDB = Network()
 
-    def _update_call_graph_cluster(self, calling_function_name, called_function_name):
-        found = False
-        for cluster in self.clusters:
-            if calling_function_name in cluster or called_function_name in cluster:
-                cluster.add(calling_function_name)
-                cluster.add(called_function_name)
-                found = True
-        if not found:
-            self.clusters.append(set([calling_function_name, called_function_name]))
 
-GDB = Network()
+def proc_io():
+    # bytes read and written by this process (rchar/wchar: all read and
+    # write calls, read_bytes/write_bytes: storage I/O)
+    io = dict()
+    try:
+        with open("/proc/self/io", "r") as fd:
+            for line in fd:
+                name, value = line.split(":")
+                io[name] = int(value)
+    except OSError:
+        pass
+    return io
+
+
+def cpu_time():
+    # user and system time of this process and its reaped worker processes
+    time_used = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        time_used += usage.ru_utime + usage.ru_stime
+    return time_used
+
+
+class Stats(object):
+    # wall and CPU time per phase for --profile and --stats-json. Phases
+    # can carry "events", "bytes_read" and "bytes_written", rates are
+    # derived from them
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.cpu_start = cpu_time()
+        self.phases = list()
+        self.active = list()
+        self.per_cpu = None
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        phase = {"name": name}
+        self.active.append(phase)
+        wall, cpu = time.perf_counter(), cpu_time()
+        try:
+            yield phase
+        finally:
+            phase["wall"] = time.perf_counter() - wall
+            phase["cpu"] = cpu_time() - cpu
+            self.active.pop()
+            self.phases.append(phase)
+
+    def attach(self, name, value):
+        # adds to the innermost running phase
+        if self.active:
+            self.active[-1][name] = self.active[-1].get(name, 0) + value
+
+    def report(self, args):
+        if not args.profile and not args.stats_json:
+            return
+        for phase in self.phases:
+            for name in ("events", "bytes_read", "bytes_written"):
+                if name in phase and phase["wall"] > 0:
+                    phase[f"{name}_per_second"] = phase[name] / phase["wall"]
+        stats = {
+            "subcommand": args.subcommand,
+            "wall": time.perf_counter() - self.start,
+            "cpu": cpu_time() - self.cpu_start,
+            # ru_maxrss is in KiB on Linux
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+            "peak_rss_children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+            "io": proc_io(),
+            "phases": self.phases,
+        }
+        if self.per_cpu is not None:
+            stats["per_cpu"] = self.per_cpu
+        if args.stats_json:
+            with open(args.stats_json, "w") as fd:
+                json.dump(stats, fd, indent=2)
+            print(f"wrote stats to {args.stats_json}")
+        if args.profile:
+            print(json.dumps(stats, indent=2))
+
+
+STATS = Stats()
+
+
+def filepath_verdict(filepath, include, exclude):
+    # substring matches, like "net" for net/ and drivers/net/
+    if include and not filepath:
+        return False
+    if not filepath:
+        return True
+    for exclude_filepath in exclude:
+        if exclude_filepath in filepath:
+            return False
+    if not include:
+        return True
+    for include_filepath in include:
+        if include_filepath in filepath:
+            return True
+    return False
 
 def get_file_size(file_path):
     try:
@@ -158,11 +469,14 @@ def convert_size(size_in_bytes):
     else:
         return f"{size_in_bytes / (1024 * 1024 * 1024):.2f} GiB"
 
-def graph_function_call_frequency2(args):
+def graph_function_call_frequency2(args, nodes):
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+    import numpy as np
     data = []
-    for node in GDB.nodes(args, filter_calls=args.filter_execution_no):
-        cumulative_called = GDB.executed_no(node.name)
-        data.append([node.name, cumulative_called])
+    for node in nodes:
+        cumulative_called = GDB.executed_no(node)
+        data.append([GDB.names[node], cumulative_called])
     sorted_data = sorted(data, key=lambda x: x[1], reverse=True)
     names, occurrences = zip(*sorted_data)
     limit = 35
@@ -197,11 +511,18 @@ def graph_function_call_frequency2(args):
     plt.savefig("function-calls.png", dpi=600, bbox_inches="tight")
     plt.close()
 
-def graph_function_call_frequency(args):
+def graph_function_call_frequency(args, nodes):
+    if not nodes:
+        print("no function calls to plot")
+        return
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+    from matplotlib.ticker import ScalarFormatter
+    import numpy as np
     data = []
-    for node in GDB.nodes(args, filter_calls=args.filter_execution_no):
-        cumulative_called = GDB.executed_no(node.name)
-        data.append([node.name, cumulative_called])
+    for node in nodes:
+        cumulative_called = GDB.executed_no(node)
+        data.append([GDB.names[node], cumulative_called])
     sorted_data = sorted(data, key=lambda x: x[1], reverse=True)
     names, occurrences = zip(*sorted_data)
     limit = 30
@@ -251,6 +572,77 @@ def make_file_world_readable(file_path):
         print(f"You don't have permission to change the file permissions.")
 
 
+FTRACE_FILTER_BATCH = 64 * 1024
+
+
+def ftrace_read_list(name):
+    # current content of set_ftrace_filter & friends, comments stripped
+    with open(os.path.join(FTRACE_DIR, name), "r") as fd:
+        return [line.strip() for line in fd if line.strip() and not line.startswith("#")]
+
+
+def ftrace_write_list(name, entries, separator="\n"):
+    # the list is truncated on open; large lists are written in batches,
+    # an entry is never split between two writes
+    fd = os.open(os.path.join(FTRACE_DIR, name), os.O_WRONLY | os.O_TRUNC)
+    try:
+        batch = ""
+        for entry in entries:
+            if len(batch) + len(entry) + 1 > FTRACE_FILTER_BATCH:
+                os.write(fd, batch.encode())
+                batch = ""
+            batch += entry + separator
+        if batch:
+            os.write(fd, batch.encode())
+    finally:
+        os.close(fd)
+
+
+def available_filter_functions():
+    functions = set()
+    with open(os.path.join(FTRACE_DIR, "available_filter_functions"), "r") as fd:
+        for line in fd:
+            # module functions are listed as "name [module]"
+            functions.add(line.split()[0])
+    return functions
+
+
+def record_filter_functions(args):
+    # resolves the filepath filters via the symbol map into function lists
+    # for set_ftrace_filter and set_ftrace_notrace, None if they cannot
+    # be resolved
+    if not args.filter_filepath and not args.exclude_filepath:
+        return None, None
+    map_db = load_symbol_filepath_map(args)
+    if not map_db:
+        print(f"filepath filters require a symbol map, {args.symbol_file_path} not found")
+        return None
+    traceable = available_filter_functions()
+    trace = notrace = None
+    if args.filter_filepath:
+        trace = [symbol for symbol, filepath in map_db.symbol.items()
+                 if symbol in traceable and filepath_verdict(filepath, args.filter_filepath, ())]
+    if args.exclude_filepath:
+        notrace = [symbol for symbol, filepath in map_db.symbol.items()
+                   if symbol in traceable and not filepath_verdict(filepath, (), args.exclude_filepath)]
+    return trace, notrace
+
+
+def record_filter_pids(args):
+    pids = list(args.pid or ())
+    if args.comm:
+        # all threads, set_ftrace_pid works on task ids
+        for task_path in glob.glob("/proc/[0-9]*/task/[0-9]*/comm"):
+            try:
+                with open(task_path, "r") as fd:
+                    comm = fd.read().strip()
+            except OSError:
+                continue
+            if comm in args.comm:
+                pids.append(task_path.split("/")[4])
+    return pids
+
+
 def tracing_enable(args):
     env = types.SimpleNamespace()
 
@@ -261,13 +653,63 @@ def tracing_enable(args):
         )
         return None
 
+    filters = record_filter_functions(args)
+    if filters is None:
+        return None
+    trace, notrace = filters
+    if trace is not None and not trace:
+        print(f"no traceable function matches {','.join(args.filter_filepath)}")
+        return None
+    pids = record_filter_pids(args)
+    if (args.pid or args.comm) and not pids:
+        print("no task matches the pid/comm filter")
+        return None
+
+    # saved to restore them in tracing_disable()
+    env.saved_filters = dict()
+    for name in ("set_ftrace_filter", "set_ftrace_notrace", "set_ftrace_pid"):
+        env.saved_filters[name] = ftrace_read_list(name)
+    try:
+        if trace:
+            print(f"Limit recording to {len(trace)} functions")
+            ftrace_write_list("set_ftrace_filter", trace)
+        if notrace:
+            print(f"Exclude {len(notrace)} functions from recording")
+            ftrace_write_list("set_ftrace_notrace", notrace)
+        if pids:
+            print(f"Limit recording to pids {' '.join(pids)}")
+            ftrace_write_list("set_ftrace_pid", pids, separator=" ")
+    except OSError as e:
+        # a batch rejected by the kernel leaves a partial list behind
+        print(f"Setting the ftrace filters failed: {e}")
+        tracing_restore_filters(env)
+        return None
+
     # we are not interessted in timekeeping, lower the overhead by using
     # a counter
     with open(os.path.join(FTRACE_DIR, "trace_clock"), "w") as fd:
         fd.write("counter")
 
-    with open(os.path.join(FTRACE_DIR, "current_tracer"), "w") as fd:
-        fd.write("function")
+    if args.sample_on:
+        # tracing_on defaults to 1, the tracer would run from now on until
+        # the end of the first window, outside of the measured on-time
+        with open(os.path.join(FTRACE_DIR, "tracing_on"), "w") as fd:
+            fd.write("0")
+
+    env.mode = args.mode
+    if env.mode == "profile":
+        # in-kernel hit counters, nothing goes through the ring buffer.
+        # Enabling resets the counters.
+        with open(os.path.join(FTRACE_DIR, "function_profile_enabled"), "w") as fd:
+            fd.write("1")
+    elif env.mode == "graph":
+        # entry and exit of every call, the nesting gives the whole stack
+        # without a stack trace per event like func_stack_trace
+        with open(os.path.join(FTRACE_DIR, "current_tracer"), "w") as fd:
+            fd.write("function_graph")
+    else:
+        with open(os.path.join(FTRACE_DIR, "current_tracer"), "w") as fd:
+            fd.write("function")
 
     with open(os.path.join(FTRACE_DIR, "buffer_size_kb"), "r") as fd:
         buffer_size = int(fd.read()) * 1024
@@ -278,16 +720,23 @@ def tracing_enable(args):
             print(f"Limit recording to CPU mask {args.cpumask}")
             fd.write(args.cpumask)
 
-    with open(os.path.join(FTRACE_DIR, "tracing_on"), "w") as fd:
-        fd.write("1")
+    if not args.sample_on:
+        # with sampling the windows switch tracing on, see record_duty_cycle()
+        with open(os.path.join(FTRACE_DIR, "tracing_on"), "w") as fd:
+            fd.write("1")
 
     return env
 
 
-def tracing_disable():
+def tracing_disable(env):
     with open(os.path.join(FTRACE_DIR, "tracing_on"), "w") as fd:
         fd.write("0")
 
+    if env.mode == "profile":
+        # counters stay readable until the profiler is enabled again
+        with open(os.path.join(FTRACE_DIR, "function_profile_enabled"), "w") as fd:
+            fd.write("0")
+
     with open(os.path.join(FTRACE_DIR, "current_tracer"), "w") as fd:
         fd.write("nop")
 
@@ -297,8 +746,68 @@ def tracing_disable():
     with open(os.path.join(FTRACE_DIR, "tracing_cpumask"), "w") as fd:
         fd.write("0")
 
+    tracing_restore_filters(env)
+
+
+def tracing_restore_filters(env):
+    for name, entries in env.saved_filters.items():
+        if name == "set_ftrace_pid":
+            # an empty list reads as "no pid"
+            entries = [entry for entry in entries if entry != "no pid"]
+            ftrace_write_list(name, entries, separator=" ")
+        else:
+            ftrace_write_list(name, entries)
+
+
+COMPRESSORS = {
+    "gzip": lambda file_path, level: gzip.open(file_path, "wb", compresslevel=1 if level is None else level),
+    "lzma": lambda file_path, level: lzma.open(file_path, "wb", preset=0 if level is None else level),
+}
 
-def record_data(env, record_time):
+
+COMPRESS_QUEUE_CHUNKS = 64
+
+
+class CompressedOutput(object):
+    # the pipe reader only enqueues the data, compression and disk I/O
+    # happen in a dedicated writer thread. The queue is bounded: if the
+    # codec falls behind, write() blocks, the reader stops draining the
+    # pipe and the kernel overwrites the oldest ring buffer pages. The
+    # loss shows up as missed events instead of growing memory.
+    def __init__(self, file_path, compress, level=None):
+        self.chunks = queue.Queue(maxsize=COMPRESS_QUEUE_CHUNKS)
+        self.thread = threading.Thread(target=self._writer, args=(file_path, compress, level), daemon=True)
+        self.thread.start()
+
+    def _writer(self, file_path, compress, level):
+        with COMPRESSORS[compress](file_path, level) as output:
+            while True:
+                data = self.chunks.get()
+                if data is None:
+                    break
+                output.write(data)
+
+    def write(self, data):
+        self.chunks.put(data)
+
+    def close(self):
+        self.chunks.put(None)
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def record_output(file_path, compress=None, level=None):
+    if compress:
+        return CompressedOutput(file_path, compress, level)
+    return open(file_path, "wb")
+
+
+def record_data(env, record_time, compress=None, compress_level=None, output_file=RECORD_OUT_FILE):
     pipe_path = os.path.join(FTRACE_DIR, "trace_pipe")
 
     # Check if trace_pipe exists
@@ -309,7 +818,7 @@ def record_data(env, record_time):
     # Open the trace_pipe for reading
     with open(pipe_path, "rb") as trace_pipe:
         try:
-            with open(RECORD_OUT_FILE, "wb") as output:
+            with record_output(output_file, compress, compress_level) as output:
                 start_time = time.time()
                 if record_time:
                     end_time = start_time + record_time
@@ -325,17 +834,536 @@ def record_data(env, record_time):
             print("Recording interrupted by the user.")
         except Exception as e:
             print(f"Error: {e}")
-    print(f"Wrote data to {RECORD_OUT_FILE}")
-    make_file_world_readable(RECORD_OUT_FILE)
-    print(f"Record filesize: {convert_size(get_file_size(RECORD_OUT_FILE))}")
+    print(f"Wrote data to {output_file}")
+    make_file_world_readable(output_file)
+    print(f"Record filesize: {convert_size(get_file_size(output_file))}")
+    return get_file_size(output_file)
+
+
+def record_data_aggregate(env, record_time, compress=None, compress_level=None):
+    # parse the lines while they arrive and keep only the call graph
+    # aggregate, memory is bounded by the number of distinct edges
+    pipe_path = os.path.join(FTRACE_DIR, "trace_pipe")
+    if not os.path.exists(pipe_path):
+        print("trace_pipe not found. Make sure the Linux kernel tracing is enabled.")
+        sys.exit(1)
 
+    parser = FtraceTextParser(tasks=True)
+    pipe_fd = os.open(pipe_path, os.O_RDONLY | os.O_NONBLOCK)
+    poller = select.poll()
+    poller.register(pipe_fd, select.POLLIN)
+    try:
+        end_time = time.time() + record_time if record_time else float("inf")
+        while time.time() < end_time:
+            if not poller.poll(100):
+                continue
+            try:
+                parser.feed(os.read(pipe_fd, env.buffer_size))
+            except BlockingIOError:
+                continue
+    except KeyboardInterrupt:
+        print("Recording interrupted by the user.")
+    except Exception as e:
+        print(f"Error: {e}")
+    finally:
+        os.close(pipe_fd)
+
+    result = parser.result()
+    network = Network()
+    for (caller, called), calls in result.edges.items():
+        network.add(caller, called, None, calls=calls)
+    network.add_task_calls(result, None)
+    events, missed_events = result.events, result.missed_events
+    aggregate_write(AGGREGATE_FILE, network, events, missed_events, compress, compress_level)
+    make_file_world_readable(AGGREGATE_FILE)
+    print(f"Wrote aggregate of {events} events, {len(network.edges)} distinct calls to {AGGREGATE_FILE}")
+    print(f"Record filesize: {convert_size(get_file_size(AGGREGATE_FILE))}")
+    STATS.attach("events", events)
+    return get_file_size(AGGREGATE_FILE)
+
+
+def record_data_profile(env, record_time):
+    try:
+        if record_time:
+            time.sleep(record_time)
+        else:
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        print("Recording interrupted by the user.")
+    return 0
+
+
+def read_function_profile(network):
+    # merges the per CPU trace_stat/functionN tables into the node counts:
+    #   Function                               Hit    Time            Avg
+    #   --------                               ---    ----            ---
+    #   schedule                             21530    2340234 us     108.6 us
+    events = 0
+    for stat_path in sorted(glob.glob(os.path.join(FTRACE_DIR, "trace_stat", "function[0-9]*"))):
+        with open(stat_path, "r") as fd:
+            for line in fd:
+                atoms = line.split()
+                if len(atoms) < 2 or not atoms[1].isdigit():
+                    continue
+                hits = int(atoms[1])
+                network.add_node_calls(network.intern(atoms[0], None), hits)
+                events += hits
+    return events
+
+
+def aggregate_write(file_path, network, events, missed_events, compress=None, compress_level=None, **extra):
+    aggregate = network.aggregate()
+    aggregate["version"] = AGGREGATE_VERSION
+    aggregate["events"] = events
+    aggregate["missed_events"] = missed_events
+    aggregate.update(extra)
+    if compress:
+        with COMPRESSORS[compress](file_path, compress_level) as fd:
+            fd.write(json.dumps(aggregate, separators=(",", ":")).encode())
+        return
+    with open(file_path, "w") as fd:
+        json.dump(aggregate, fd, separators=(",", ":"))
+
+
+def aggregate_read(file_path):
+    # compressed aggregates are detected like compressed recordings
+    with open_data_file(file_path) as fd:
+        aggregate = json.load(fd)
+    if aggregate.get("version") != AGGREGATE_VERSION:
+        raise ValueError(f"{file_path}: unsupported aggregate version {aggregate.get('version')}")
+    return aggregate
+
+
+RE_FTRACE_FORMAT_FIELD = re.compile(r"field:(.*?);\s*offset:(\d+);\s*size:(\d+);")
+
+
+def ftrace_format_fields(format_path):
+    # parses the events/*/format (and header_page) description into
+    # {field_name: [offset, size]}, plus the event id if available
+    fields = dict()
+    event_id = None
+    with open(format_path, "r") as fd:
+        for line in fd:
+            line = line.strip()
+            if line.startswith("ID:"):
+                event_id = int(line.split()[1])
+                continue
+            m = RE_FTRACE_FORMAT_FIELD.match(line)
+            if not m:
+                continue
+            name = m.group(1).split()[-1].split("[")[0]
+            # header_page defines "overwrite" at the commit offset, first wins
+            if name not in fields:
+                fields[name] = [int(m.group(2)), int(m.group(3))]
+    return event_id, fields
+
+
+def raw_page_size():
+    subbuf_path = os.path.join(FTRACE_DIR, "buffer_subbuf_size_kb")
+    if os.path.exists(subbuf_path):
+        with open(subbuf_path, "r") as fd:
+            return int(fd.read()) * 1024
+    return os.sysconf("SC_PAGE_SIZE")
+
+
+def record_kallsyms(output_path):
+    # function addresses are resolved later in visualize, save the text
+    # symbols of the recording kernel sorted by address
+    symbols = []
+    with open("/proc/kallsyms", "r") as fd:
+        for line in fd:
+            atoms = line.split()
+            if len(atoms) < 3 or atoms[1] not in ("t", "T"):
+                continue
+            symbols.append((int(atoms[0], 16), atoms[2]))
+    symbols.sort()
+    if symbols and symbols[-1][0] == 0:
+        print("kallsyms addresses are hidden, check /proc/sys/kernel/kptr_restrict")
+    with open(output_path, "w") as fd:
+        for address, name in symbols:
+            fd.write(f"{address:x} {name}\n")
+    make_file_world_readable(output_path)
+
+
+def record_cmdlines():
+    cmdlines = dict()
+    try:
+        with open(os.path.join(FTRACE_DIR, "saved_cmdlines"), "r") as fd:
+            for line in fd:
+                atoms = line.strip().split(maxsplit=1)
+                if len(atoms) == 2:
+                    cmdlines[atoms[0]] = atoms[1]
+    except OSError:
+        pass
+    return cmdlines
+
+
+def record_cpus():
+    per_cpu_dir = os.path.join(FTRACE_DIR, "per_cpu")
+    cpus = [int(entry[3:]) for entry in os.listdir(per_cpu_dir) if entry.startswith("cpu")]
+    return sorted(cpus)
+
+
+def record_raw_meta():
+    _, header = ftrace_format_fields(os.path.join(FTRACE_DIR, "events/header_page"))
+    event_id, fields = ftrace_format_fields(os.path.join(FTRACE_DIR, "events/ftrace/function/format"))
+    return {
+        "byteorder": sys.byteorder,
+        "page_size": raw_page_size(),
+        "header": header,
+        "function_id": event_id,
+        "function": fields,
+    }
+
+
+def record_cpu_reader(pipe_path, output_path, chunk_size, stop, compress=None, compress_level=None):
+    # one reader per CPU: sleeps in poll() until the kernel signals data and
+    # moves it via splice() through a pipe into the output file, the data
+    # is never copied to userspace. Compressed output requires a copy.
+    pipe_fd = os.open(pipe_path, os.O_RDONLY | os.O_NONBLOCK)
+    if compress:
+        # the writer thread owns the file
+        output, output_fd = CompressedOutput(output_path, compress, compress_level), None
+    else:
+        output, output_fd = None, os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    splice_r, splice_w = os.pipe()
+    try:
+        fcntl.fcntl(splice_w, fcntl.F_SETPIPE_SZ, chunk_size)
+    except (AttributeError, OSError):
+        pass
+    poller = select.poll()
+    poller.register(pipe_fd, select.POLLIN)
+    use_splice = hasattr(os, "splice") and not compress
+    try:
+        while not stop.is_set():
+            if not poller.poll(100):
+                continue
+            try:
+                if use_splice:
+                    pending = os.splice(pipe_fd, splice_w, chunk_size, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+                    while pending > 0:
+                        pending -= os.splice(splice_r, output_fd, pending, flags=os.SPLICE_F_MOVE)
+                elif output:
+                    output.write(os.read(pipe_fd, chunk_size))
+                else:
+                    data = os.read(pipe_fd, chunk_size)
+                    while data:
+                        data = data[os.write(output_fd, data):]
+            except BlockingIOError:
+                continue
+            except OSError as e:
+                if not use_splice:
+                    raise
+                # some kernels do not implement splice for this file
+                print(f"splice not possible for {pipe_path} ({e}), fallback to read")
+                use_splice = False
+    finally:
+        os.close(pipe_fd)
+        if output_fd is not None:
+            os.close(output_fd)
+        os.close(splice_r)
+        os.close(splice_w)
+        if output:
+            output.close()
+
+
+def record_data_per_cpu(env, record_time, record_format, compress=None, compress_level=None, sample=None):
+    # sample: (on_time, period) to trace in windows only, see record_duty_cycle()
+    cpus = record_cpus()
+    meta = {"version": 1, "format": record_format, "cpus": cpus}
+    if record_format == "raw":
+        # copy the binary ring buffer pages, no in-kernel formatting is required
+        meta.update(record_raw_meta())
+        record_kallsyms(RAW_SYMBOL_FILE)
+        pipe_name, output_file = "trace_pipe_raw", RAW_CPU_FILE
+        # splice of trace_pipe_raw works on whole pages
+        chunk_size = max(meta["page_size"] * 16, env.buffer_size // 16)
+        chunk_size -= chunk_size % meta["page_size"]
+    else:
+        pipe_name, output_file = "trace_pipe", TEXT_CPU_FILE
+        chunk_size = max(64 * 1024, env.buffer_size // 16)
+
+    stop = threading.Event()
+    readers = []
+    for cpu in cpus:
+        pipe_path = os.path.join(FTRACE_DIR, "per_cpu", f"cpu{cpu}", pipe_name)
+        reader = threading.Thread(
+            target=record_cpu_reader,
+            args=(pipe_path, output_file.format(cpu), chunk_size, stop, compress, compress_level),
+            daemon=True,
+        )
+        reader.start()
+        readers.append(reader)
+    try:
+        if sample:
+            meta["sampling"] = record_duty_cycle(record_time, *sample)
+        elif record_time:
+            stop.wait(record_time)
+        else:
+            while not stop.wait(3600):
+                pass
+    except KeyboardInterrupt:
+        print("Recording interrupted by the user.")
+    stop.set()
+    for reader in readers:
+        reader.join()
+
+    meta["cmdlines"] = record_cmdlines()
+    with open(RECORD_META_FILE, "w") as fd:
+        json.dump(meta, fd)
+    make_file_world_readable(RECORD_META_FILE)
+    record_size = get_file_size(RECORD_META_FILE)
+    if record_format == "raw":
+        record_size += get_file_size(RAW_SYMBOL_FILE)
+    for cpu in cpus:
+        record_size += get_file_size(output_file.format(cpu))
+        make_file_world_readable(output_file.format(cpu))
+    print(f"Wrote data to {output_file.format('*')}")
+    print(f"Record filesize: {convert_size(record_size)}")
+    return record_size
+
+
+def read_per_cpu_stats():
+    # per_cpu/cpuN/stats, e.g. "overrun: 0" or "dropped events: 0", as
+    # {cpu: {"overrun": 0, "dropped_events": 0, ...}}
+    per_cpu = dict()
+    for cpu in record_cpus():
+        stats = dict()
+        try:
+            with open(os.path.join(FTRACE_DIR, "per_cpu", f"cpu{cpu}", "stats"), "r") as fd:
+                for line in fd:
+                    name, _, value = line.partition(":")
+                    try:
+                        stats[name.strip().replace(" ", "_")] = float(value) if "." in value else int(value)
+                    except ValueError:
+                        continue
+        except OSError:
+            continue
+        per_cpu[cpu] = stats
+    return per_cpu
+
+
+def per_cpu_lost(before, after):
+    # events the ring buffers lost between two read_per_cpu_stats()
+    lost = 0
+    for cpu, stats in after.items():
+        for name in ("overrun", "dropped_events"):
+            lost += stats.get(name, 0) - before.get(cpu, {}).get(name, 0)
+    return lost
+
+
+def record_duty_cycle(record_time, on_time, period):
+    # tracing is switched on for on_time seconds every period seconds.
+    # The measured on-time and the ring buffer losses of every window are
+    # kept, visualize extrapolates the counts from them
+    tracing_on = os.path.join(FTRACE_DIR, "tracing_on")
+    windows = []
+    begin = time.monotonic()
+    end = begin + record_time if record_time else float("inf")
+    window = None
+    try:
+        while True:
+            window_start = begin + len(windows) * period
+            if window_start >= end:
+                # the last off period belongs to the observation time
+                time.sleep(max(end - time.monotonic(), 0))
+                break
+            time.sleep(max(window_start - time.monotonic(), 0))
+            before = read_per_cpu_stats()
+            with open(tracing_on, "w") as fd:
+                fd.write("1")
+            window = time.monotonic()
+            time.sleep(max(min(on_time, end - window), 0))
+            with open(tracing_on, "w") as fd:
+                fd.write("0")
+            windows.append({"start": window - begin, "on_time": time.monotonic() - window,
+                            "lost": per_cpu_lost(before, read_per_cpu_stats())})
+            window = None
+    except KeyboardInterrupt:
+        print("Recording interrupted by the user.")
+        with open(tracing_on, "w") as fd:
+            fd.write("0")
+        if window is not None:
+            windows.append({"start": window - begin, "on_time": time.monotonic() - window,
+                            "lost": per_cpu_lost(before, read_per_cpu_stats())})
+    on_total = sum(window["on_time"] for window in windows)
+    observation_time = time.monotonic() - begin
+    print(f"Traced {len(windows)} windows, {on_total:.3f}s of {observation_time:.3f}s")
+    return {"on_time": on_time, "period": period, "observation_time": observation_time, "windows": windows}
 
 
 def record(args):
+    if args.mode == "graph" and (args.aggregate or args.format == "raw" or args.per_cpu):
+        print("--mode graph records text into a single file, --aggregate, --format raw and --per-cpu are not supported")
+        return 1
+    if args.aggregate and (args.format == "raw" or args.per_cpu):
+        print("--aggregate parses the text trace while recording, --format raw and --per-cpu are not supported")
+        return 1
+    if args.sample_on:
+        if args.mode != "function" or args.aggregate:
+            print("--sample-on requires --mode function and does not support --aggregate")
+            return 1
+        if not 0 < args.sample_on < args.sample_period:
+            print("--sample-on must be shorter than --sample-period")
+            return 1
+        print(f"Sampling {args.sample_on}s every {args.sample_period}s")
     print(f"Record mode - now starting recording traces for {args.record_time} seconds")
-    env = tracing_enable(args)
-    record_data(env, args.record_time)
-    tracing_disable()
+    with STATS.phase("tracing-enable"):
+        env = tracing_enable(args)
+    if env is None:
+        return 1
+    with STATS.phase("record") as phase:
+        if args.mode == "profile":
+            record_size = record_data_profile(env, args.record_time)
+        elif args.mode == "graph":
+            record_size = record_data(env, args.record_time, args.compress, args.compress_level,
+                                      output_file=RECORD_GRAPH_FILE)
+        elif args.aggregate:
+            record_size = record_data_aggregate(env, args.record_time, args.compress, args.compress_level)
+        elif args.format == "raw" or args.per_cpu or args.sample_on:
+            # the per CPU readers do not block while tracing is switched off
+            sample = (args.sample_on, args.sample_period) if args.sample_on else None
+            record_size = record_data_per_cpu(env, args.record_time, args.format, args.compress,
+                                              args.compress_level, sample=sample)
+        else:
+            record_size = record_data(env, args.record_time, args.compress, args.compress_level)
+        phase["bytes_written"] = record_size
+    if args.profile or args.stats_json:
+        # the ring buffer is reset with the tracer, read overruns before
+        STATS.per_cpu = read_per_cpu_stats()
+    with STATS.phase("tracing-disable"):
+        tracing_disable(env)
+    if args.mode == "profile":
+        network = Network()
+        with STATS.phase("read-function-profile") as phase:
+            events = read_function_profile(network)
+            phase["events"] = events
+        aggregate_write(AGGREGATE_FILE, network, events, 0)
+        make_file_world_readable(AGGREGATE_FILE)
+        print(f"Wrote function profile of {len(network.names)} functions, {events} calls to {AGGREGATE_FILE}")
+    return 0
+
+
+class SpaceSaving(object):
+    # heavy hitters in fixed memory (Space-Saving algorithm): at most
+    # capacity counters, a new key takes over the smallest counter and
+    # inherits its count as error. A count overestimates the real count
+    # by at most its error.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.counters = dict()
+        # one (count, key) entry per key, entries are refreshed lazily
+        # when they reach the top of the heap
+        self.heap = []
+
+    def add(self, key, count=1):
+        counter = self.counters.get(key)
+        if counter is not None:
+            counter[0] += count
+            return
+        if len(self.counters) < self.capacity:
+            self.counters[key] = [count, 0]
+            heapq.heappush(self.heap, (count, key))
+            return
+        while True:
+            minimum, evicted = self.heap[0]
+            current = self.counters[evicted][0]
+            if current == minimum:
+                break
+            heapq.heapreplace(self.heap, (current, evicted))
+        del self.counters[evicted]
+        self.counters[key] = [minimum + count, minimum]
+        heapq.heapreplace(self.heap, (minimum + count, key))
+
+    def top(self, n):
+        # [(key, count, error), ...], highest count first
+        counters = heapq.nlargest(n, self.counters.items(), key=lambda item: item[1][0])
+        return [(key, count, error) for key, (count, error) in counters]
+
+
+def live_show(args, functions, edges, stats):
+    interval = max(stats.interval, 1e-9)
+    events_total = max(stats.events, 1)
+    lost_percent = stats.missed_events / max(stats.events + stats.missed_events, 1) * 100
+    columns = shutil.get_terminal_size().columns
+    lines = [
+        f"kernel-magnifier live - {stats.elapsed:.0f}s, {stats.events} events, "
+        f"{stats.missed_events} lost ({lost_percent:.2f}%), {args.capacity} counters",
+        f"{stats.interval_events / interval:.0f} events/s, "
+        f"{stats.interval_missed_events / interval:.0f} lost events/s",
+        "",
+        f"{'calls':>12} {'error':>10} {'share':>7}  function",
+    ]
+    for name, count, error in functions.top(args.top):
+        lines.append(f"{count:>12} {error:>10} {count / events_total * 100:6.2f}%  {name}")
+    lines += ["", f"{'calls':>12} {'error':>10} {'share':>7}  caller -> called"]
+    for (caller, called), count, error in edges.top(args.top):
+        lines.append(f"{count:>12} {error:>10} {count / events_total * 100:6.2f}%  {caller} -> {called}")
+    # redraw from the top left corner
+    print("\033[H\033[J" + "\n".join(line[:columns] for line in lines), flush=True)
+
+
+def live(args):
+    # top-n functions and calls while tracing, nothing is written to disk.
+    # Lines are parsed per interval and only the heavy hitter counters are
+    # kept, memory does not grow with the runtime
+    pipe_path = os.path.join(FTRACE_DIR, "trace_pipe")
+    if not os.path.exists(pipe_path):
+        print("trace_pipe not found. Make sure the Linux kernel tracing is enabled.")
+        return 1
+    with STATS.phase("tracing-enable"):
+        env = tracing_enable(args)
+    if env is None:
+        return 1
+
+    functions = SpaceSaving(args.capacity)
+    edges = SpaceSaving(args.capacity)
+    stats = types.SimpleNamespace(events=0, missed_events=0, bytes_read=0, elapsed=0, interval=0,
+                                  interval_events=0, interval_missed_events=0)
+    parser = FtraceTextParser()
+    pending = b""
+    pipe_fd = os.open(pipe_path, os.O_RDONLY | os.O_NONBLOCK)
+    poller = select.poll()
+    poller.register(pipe_fd, select.POLLIN)
+    try:
+        with STATS.phase("live") as phase:
+            start = interval_start = time.time()
+            end_time = start + args.record_time if args.record_time else float("inf")
+            while time.time() < end_time:
+                if poller.poll(100):
+                    try:
+                        block = os.read(pipe_fd, env.buffer_size)
+                    except BlockingIOError:
+                        continue
+                    stats.bytes_read += len(block)
+                    # complete lines only, the parser is replaced every interval
+                    data = pending + block
+                    cut = data.rfind(b"\n") + 1
+                    parser.feed(data[:cut])
+                    pending = data[cut:]
+                now = time.time()
+                if now - interval_start < args.interval:
+                    continue
+                result = parser.result()
+                parser = FtraceTextParser()
+                for (caller, called), calls in result.edges.items():
+                    edges.add((caller, called), calls)
+                    functions.add(called, calls)
+                stats.events += result.events
+                stats.missed_events += result.missed_events
+                stats.interval_events = result.events
+                stats.interval_missed_events = result.missed_events
+                stats.interval = now - interval_start
+                stats.elapsed = now - start
+                live_show(args, functions, edges, stats)
+                interval_start = now
+                phase.update(events=stats.events, bytes_read=stats.bytes_read)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        os.close(pipe_fd)
+        tracing_disable(env)
     return 0
 
 
@@ -376,6 +1404,316 @@ def parse_ftrace_line(line):
     return None, missed_events
 
 
+def split_task_prefix(prefix):
+    # b"  kworker/u64:1-145123  [000" into ("kworker/u64:1", 145123, 0)
+    head, _, cpu = prefix.rpartition(b"[")
+    task, _, pid = head.strip().rpartition(b"-")
+    try:
+        return task.decode(errors="replace"), int(pid), int(cpu)
+    except ValueError:
+        return None
+
+
+class FtraceTextParser(object):
+    # fast path for the function tracer text format, works on blocks of
+    # bytes. A call is identified by the line tail behind the last ": "
+    # ("func <-parent"), every new tail is mapped once to a call index and
+    # checked by parse_ftrace_line(). Lines which do not fit the fast path
+    # are handled by it completely.
+    # With tasks, the line prefix in front of "] " ("task-pid  [cpu") is
+    # mapped to a task index as well and task << 32 | call is counted.
+    # With a window size the timestamp in front of the tail is used too,
+    # calls are additionally counted per (window, call).
+    def __init__(self, window=None, tasks=False):
+        self.tail_calls = dict()
+        self.prefix_tasks = dict()
+        # [(parent, function)] and [(task, pid, cpu)], looked up by index
+        self.calls = list()
+        self.call_ids = dict()
+        self.call_counts = list()
+        self.tasks = list()
+        self.task_ids = dict()
+        self.task_calls = dict() if tasks else None
+        self.events = 0
+        self.missed_events = 0
+        self.pending = b""
+        self.window = window
+        self.window_calls = dict()
+
+    def feed(self, block):
+        lines = (self.pending + block).split(b"\n")
+        self.pending = lines.pop()
+        if self.window:
+            self._feed_windows(lines)
+            return
+        if self.task_calls is not None:
+            self._feed_tasks(lines)
+            return
+        counts = self.call_counts
+        tail_calls = self.tail_calls
+        for line in lines:
+            colon = line.rfind(b": ")
+            call = tail_calls.get(line[colon + 2:])
+            if call is not None and line.find(b"] ", 0, colon) > 0:
+                counts[call] += 1
+            else:
+                self._count_new(line, colon, line.find(b"] ", 0, colon))
+
+    def _feed_tasks(self, lines):
+        counts = self.task_calls
+        tail_calls = self.tail_calls
+        prefix_tasks = self.prefix_tasks
+        for line in lines:
+            colon = line.rfind(b": ")
+            bracket = line.find(b"] ", 0, colon)
+            call = tail_calls.get(line[colon + 2:])
+            task = prefix_tasks.get(line[:bracket])
+            if call is None or task is None or bracket <= 0:
+                self._count_new(line, colon, bracket)
+                continue
+            key = task << 32 | call
+            counts[key] = counts.get(key, 0) + 1
+
+    def _feed_windows(self, lines):
+        window_calls = self.window_calls
+        for line in lines:
+            colon = line.rfind(b": ")
+            call = self._count_new(line, colon, line.find(b"] ", 0, colon))
+            if call is None or colon < 0:
+                # rare lines off the fast path are not windowed
+                continue
+            try:
+                # "  1207319054: func <-parent", counter or seconds
+                window = int(float(line[line.rfind(b" ", 0, colon) + 1:colon]) // self.window)
+            except ValueError:
+                continue
+            key = (window, call)
+            window_calls[key] = window_calls.get(key, 0) + 1
+
+    def _call(self, parent, function):
+        call = self.call_ids.get((parent, function))
+        if call is None:
+            call = self.call_ids[(parent, function)] = len(self.calls)
+            self.calls.append((parent, function))
+            self.call_counts.append(0)
+        return call
+
+    def _task(self, task):
+        index = self.task_ids.get(task)
+        if index is None:
+            index = self.task_ids[task] = len(self.tasks)
+            self.tasks.append(task)
+        return index
+
+    def _count(self, task, call):
+        if self.task_calls is None:
+            self.call_counts[call] += 1
+            return
+        key = task << 32 | call
+        self.task_calls[key] = self.task_calls.get(key, 0) + 1
+
+    def _count_new(self, line, colon, bracket):
+        # a new prefix for an already checked tail is split without the
+        # full line regex. Returns the index of the counted call or None
+        call = self.tail_calls.get(line[colon + 2:])
+        if call is None or bracket <= 0:
+            return self._parse_line(line, colon, bracket)
+        task = None
+        if self.task_calls is not None:
+            task = self.prefix_tasks.get(line[:bracket])
+            if task is None:
+                task = split_task_prefix(line[:bracket])
+                if task is None:
+                    return self._parse_line(line, colon, bracket)
+                task = self.prefix_tasks[line[:bracket]] = self._task(task)
+        self._count(task, call)
+        return call
+
+    def _parse_line(self, line, colon, bracket):
+        data, missed_events = parse_ftrace_line(line.decode(errors="replace").strip())
+        if missed_events:
+            self.missed_events += missed_events
+            return None
+        if not data:
+            return None
+        call = self._call(data.parent, data.function)
+        task = self._task((data.task_name, int(data.pid), int(data.cpu)))
+        tail, prefix = line[colon + 2:], line[:bracket]
+        if colon >= 0 and bracket > 0 and tail == f"{data.function} <-{data.parent}".encode():
+            self.tail_calls[tail] = call
+            if split_task_prefix(prefix) == self.tasks[task]:
+                self.prefix_tasks[prefix] = task
+        self._count(task, call)
+        return call
+
+    def result(self):
+        if self.pending:
+            line, self.pending = self.pending, b""
+            colon = line.rfind(b": ")
+            self._count_new(line, colon, line.find(b"] ", 0, colon))
+        counts = self.call_counts
+        if self.task_calls is not None:
+            counts = [0] * len(self.calls)
+            for key, calls in self.task_calls.items():
+                counts[key & 0xFFFFFFFF] += calls
+        self.events += sum(counts)
+        windows = dict()
+        for (window, call), calls in self.window_calls.items():
+            key = (window, self.calls[call][1])
+            windows[key] = windows.get(key, 0) + calls
+        # task_calls are keyed by task << 32 | call, indices into tasks
+        # and calls, see Network.add_task_calls()
+        return types.SimpleNamespace(edges=dict(zip(self.calls, counts)), tasks=self.tasks, calls=self.calls,
+                                     task_calls=self.task_calls or dict(), events=self.events,
+                                     missed_events=self.missed_events, windows=windows)
+
+
+STRUCT_FORMATS = {1: "B", 2: "H", 4: "I", 8: "Q"}
+
+
+class RawDecoder(object):
+    # decodes trace_pipe_raw ring buffer pages, layout as saved by
+    # record_raw_meta() at record time
+    def __init__(self, meta, symbol_path):
+        endian = "<" if meta["byteorder"] == "little" else ">"
+        self.page_size = meta["page_size"]
+        self.cmdlines = meta.get("cmdlines", dict())
+        self.function_id = meta["function_id"]
+        self.u32 = struct.Struct(endian + "I")
+        commit_offset, commit_size = meta["header"]["commit"]
+        self.commit_offset = commit_offset
+        self.commit = struct.Struct(endian + STRUCT_FORMATS[commit_size])
+        self.data_offset = meta["header"]["data"][0]
+        timestamp_offset, timestamp_size = meta["header"].get("timestamp", (0, 8))
+        self.timestamp_offset = timestamp_offset
+        self.timestamp = struct.Struct(endian + STRUCT_FORMATS[timestamp_size])
+        fields = meta["function"]
+        self.fields = []
+        for name in ("common_type", "common_pid", "ip", "parent_ip"):
+            offset, size = fields[name]
+            fmt = STRUCT_FORMATS[size]
+            if name == "common_pid":
+                fmt = fmt.lower()
+            self.fields.append((offset, struct.Struct(endian + fmt)))
+        self.addresses = []
+        self.names = []
+        with open(symbol_path, "r") as fd:
+            for line in fd:
+                address, name = line.split()
+                self.addresses.append(int(address, 16))
+                self.names.append(name)
+        self.symbols = dict()
+
+    def task(self, pid):
+        # like trace_pipe: comm from saved_cmdlines at record time
+        if pid == 0:
+            return "<idle>"
+        return self.cmdlines.get(str(pid), "<...>")
+
+    def symbol(self, address):
+        name = self.symbols.get(address)
+        if name is None:
+            index = bisect.bisect_right(self.addresses, address) - 1
+            if index >= 0 and address:
+                name = self.names[index]
+            else:
+                name = f"0x{address:x}"
+            self.symbols[address] = name
+        return name
+
+    def decode_page(self, page):
+        # returns (missed events, [(pid, ip, parent_ip, timestamp), ...]),
+        # timestamps are the page timestamp plus the event time deltas
+        u32 = self.u32
+        commit = self.commit.unpack_from(page, self.commit_offset)[0]
+        length = commit & ~(RB_MISSED_EVENTS | RB_MISSED_STORED)
+        missed_events = 0
+        if commit & RB_MISSED_STORED:
+            missed_events = self.commit.unpack_from(page, self.data_offset + length)[0]
+        (type_offset, type_struct), (pid_offset, pid_struct), (ip_offset, ip_struct), \
+            (parent_offset, parent_struct) = self.fields
+        events = []
+        timestamp = self.timestamp.unpack_from(page, self.timestamp_offset)[0]
+        pos = self.data_offset
+        end = min(pos + length, len(page))
+        while pos + 4 <= end:
+            header = u32.unpack_from(page, pos)[0]
+            type_len = header & 0x1f
+            if type_len == RB_TYPE_PADDING:
+                if header >> 5 == 0:
+                    break
+                pos += 4 + u32.unpack_from(page, pos + 4)[0]
+                continue
+            if type_len == RB_TYPE_TIME_EXTEND:
+                timestamp += u32.unpack_from(page, pos + 4)[0] << 27 | header >> 5
+                pos += 8
+                continue
+            if type_len == RB_TYPE_TIME_STAMP:
+                timestamp = u32.unpack_from(page, pos + 4)[0] << 27 | header >> 5
+                pos += 8
+                continue
+            timestamp += header >> 5
+            if type_len == 0:
+                payload = pos + 8
+                pos += 4 + u32.unpack_from(page, pos + 4)[0]
+            else:
+                payload = pos + 4
+                pos += 4 + type_len * 4
+            if type_struct.unpack_from(page, payload + type_offset)[0] != self.function_id:
+                continue
+            events.append((
+                pid_struct.unpack_from(page, payload + pid_offset)[0],
+                ip_struct.unpack_from(page, payload + ip_offset)[0],
+                parent_struct.unpack_from(page, payload + parent_offset)[0],
+                timestamp,
+            ))
+        return missed_events, events
+
+
+RAW_DECODER = None
+
+
+def raw_decoder():
+    # created once per (worker) process
+    global RAW_DECODER
+    if RAW_DECODER is None:
+        RAW_DECODER = RawDecoder(recording_meta(), RAW_SYMBOL_FILE)
+    return RAW_DECODER
+
+
+def graph_function_call_windows(args, nodes):
+    # calls per window of the hottest shown functions over time
+    if GDB.window_calls is None:
+        return
+    import matplotlib.pyplot as plt
+    import numpy as np
+    limit = 10
+    function_ids = sorted(nodes, key=GDB.executed_no, reverse=True)[:limit]
+    windows = (np.arange(GDB.window_calls.shape[1]) + GDB.window_first) * args.window
+
+    fig, ax = plt.subplots(figsize=(10, 6))
+    ax.spines["top"].set_visible(False)
+    ax.spines["right"].set_visible(False)
+    ax.yaxis.grid(which='major', linestyle='-', linewidth='0.5', color='black')
+    ax.set_axisbelow(True)
+    ax.ticklabel_format(style='plain')
+
+    colors = plt.cm.viridis(np.linspace(0.1, 0.9, len(function_ids)))
+    for function_id, color in zip(function_ids, colors):
+        ax.plot(windows, GDB.window_calls[function_id], label=GDB.names[function_id],
+                color=color, linewidth=1)
+
+    ax.set_xlabel(f"Trace Clock (windows of {args.window})")
+    ax.set_ylabel("Calls per Window")
+    ax.legend(fontsize=6)
+
+    plt.tight_layout()
+    filename = "function-calls-windows.png"
+    print(f"{filename} generated, {GDB.window_calls.shape[1]} windows")
+    plt.savefig(filename, dpi=300, bbox_inches="tight")
+    plt.close()
+
+
 def visualize_def_normalize_penwidth(value, max_value):
     if value <= 0:
         return 1
@@ -398,7 +1736,55 @@ def normalize_to_color(value, max_value):
         return "#{:02X}{:02X}{:02X}".format(r, g, b)
 
 
-def visualize_data(args):
+def graph_group_key(args, function_id):
+    # super-node a function is collapsed into
+    if args.collapse == "component":
+        return f"component {GDB.cluster_find(function_id)}"
+    return os.path.dirname(GDB.filepaths[function_id] or "") or "(unknown)"
+
+
+def graph_view(args, nodes, calls):
+    # reduces the graph before layout: functions are optionally collapsed
+    # into super-nodes, then just the top k edges are kept. Returns nodes
+    # as {name: (label, executed)} and calls as [(caller, called, calls)]
+    view = types.SimpleNamespace(nodes=dict(), calls=list(),
+                                 executed_max=GDB.executed_max, calls_max=GDB.calls_max)
+    if args.collapse:
+        groups = dict()
+        group_calls = dict()
+        for function_id in nodes:
+            key = graph_group_key(args, function_id)
+            functions, executed = groups.get(key, (0, 0))
+            groups[key] = (functions + 1, executed + GDB.executed_no(function_id))
+        for caller_id, called_id, edge_calls in calls:
+            edge = (graph_group_key(args, caller_id), graph_group_key(args, called_id))
+            # calls within a super-node are not shown
+            if edge[0] != edge[1]:
+                group_calls[edge] = group_calls.get(edge, 0) + edge_calls
+        for key, (functions, executed) in groups.items():
+            view.nodes[key] = (f" {key}\n{functions} functions\nExecuted: {executed}", executed)
+        view.calls = [(caller, called, edge_calls) for (caller, called), edge_calls in group_calls.items()]
+        # super-nodes are colored relative to each other
+        view.executed_max = max((executed for _, executed in groups.values()), default=0)
+        view.calls_max = max(group_calls.values(), default=0)
+    else:
+        for function_id in nodes:
+            executed = GDB.executed_no(function_id)
+            view.nodes[GDB.names[function_id]] = (f" {GDB.label(function_id, executed=executed)}", executed)
+        view.calls = [(GDB.names[caller_id], GDB.names[called_id], edge_calls)
+                      for caller_id, called_id, edge_calls in calls]
+    if args.top_edges and len(view.calls) > args.top_edges:
+        view.calls = heapq.nlargest(args.top_edges, view.calls, key=lambda call: call[2])
+        connected = set()
+        for caller, called, _ in view.calls:
+            connected.add(caller)
+            connected.add(called)
+        view.nodes = {key: node for key, node in view.nodes.items() if key in connected}
+    return view
+
+
+def graph_build(view):
+    import pygraphviz as pgv
     g = pgv.AGraph(
         strict=True,
         directed=True,
@@ -412,54 +1798,539 @@ def visualize_data(args):
     g.node_attr["fillcolor"] = "#f8f8f8"
     g.edge_attr["fontname"] = "Helvetica,Arial,sans-serif"
 
-    for node in GDB.nodes(args, filter_calls=args.filter_execution_no):
-        cumulative_called = GDB.executed_no(node.name)
-        fillcolor = normalize_to_color(cumulative_called, GDB.executed_max)
-        label = f" {node.label(executed=cumulative_called)}"
-        g.add_node(node.name, label=label, shape="box", fillcolor=fillcolor)
+    for key, (label, executed) in view.nodes.items():
+        fillcolor = normalize_to_color(executed, view.executed_max)
+        g.add_node(key, label=label, shape="box", fillcolor=fillcolor)
 
-    for caller_name, called_name, edge in GDB.calls(args, filter_calls=args.filter_execution_no):
-        penwidth = visualize_def_normalize_penwidth(edge.calls, GDB.calls_max)
+    for caller, called, edge_calls in view.calls:
+        penwidth = visualize_def_normalize_penwidth(edge_calls, view.calls_max)
         g.add_edge(
-            caller_name.name,
-            called_name.name,
-            label=f"{edge.calls}",
+            caller,
+            called,
+            label=f"{edge_calls}",
             penwidth=penwidth,
-            weight=edge.calls,
+            weight=edge_calls,
         )
-
-    g.draw(args.image_name, prog="dot")
+    return g
+
+
+def graph_layout_prog(args, view):
+    # dot does not scale to large graphs, sfdp does
+    if args.layout != "auto":
+        return args.layout
+    if len(view.nodes) + len(view.calls) > args.sfdp_threshold:
+        print(f"{len(view.nodes)} nodes and {len(view.calls)} edges exceed "
+              f"--sfdp-threshold {args.sfdp_threshold}, using sfdp layout")
+        return "sfdp"
+    return "dot"
+
+
+def graph_export(args, view):
+    # layout free export, just the (reduced) graph
+    if args.export.endswith(".json"):
+        data = {
+            "nodes": [{"name": key, "label": label.strip(), "executed": executed}
+                      for key, (label, executed) in view.nodes.items()],
+            "edges": [{"caller": caller, "called": called, "calls": edge_calls}
+                      for caller, called, edge_calls in view.calls],
+        }
+        with open(args.export, "w") as fd:
+            json.dump(data, fd)
+    else:
+        graph_build(view).write(args.export)
+    print(f"{args.export} exported, {len(view.nodes)} nodes and {len(view.calls)} edges")
+
+
+def graph_draw(g, image_name, prog, image_format=None):
+    if prog == "sfdp":
+        g.graph_attr["overlap"] = "prism"
+    if image_name is None:
+        # rendered into memory
+        return g.draw(format=image_format, prog=prog)
+    g.draw(image_name, prog=prog)
+    return image_name
+
+
+def graph_render(source, image_name, prog):
+    # pool worker, graphs are passed as DOT source
+    import pygraphviz as pgv
+    return graph_draw(pgv.AGraph(string=source), image_name, prog)
+
+
+def graph_component_calls(nodes, calls):
+    # nodes and calls per connected component, largest first. Calls never
+    # cross components, so the caller decides the component
+    components = dict()
+    for caller_id, called_id, edge_calls in calls:
+        component_nodes, component_calls = components.setdefault(GDB.cluster_find(caller_id), (set(), []))
+        component_calls.append((caller_id, called_id, edge_calls))
+        for function_id in (caller_id, called_id):
+            if function_id in nodes:
+                component_nodes.add(function_id)
+    return sorted(components.values(), key=lambda component: len(component[1]), reverse=True)
+
+
+def visualize_data(args, nodes, calls):
+    if args.split_components:
+        base, ext = os.path.splitext(args.image_name)
+        jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+        renders = []
+        with STATS.phase("graph-build"):
+            for index, (component_nodes, component_calls) in enumerate(graph_component_calls(nodes, calls)):
+                view = graph_view(args, component_nodes, component_calls)
+                renders.append((graph_build(view).string(), f"{base}-component{index}{ext}",
+                                graph_layout_prog(args, view)))
+        with STATS.phase("graph-draw"):
+            with multiprocessing.Pool(min(jobs, max(len(renders), 1))) as pool:
+                for image_name in pool.starmap(graph_render, renders):
+                    print(f"{image_name} generated")
+        return
+
+    with STATS.phase("graph-build"):
+        view = graph_view(args, nodes, calls)
+        if args.export:
+            graph_export(args, view)
+            return
+        g = graph_build(view)
+    print(f"rendering {len(view.nodes)} nodes and {len(view.calls)} edges")
+    with STATS.phase("graph-draw"):
+        graph_draw(g, args.image_name, graph_layout_prog(args, view))
     print(f"{args.image_name} generated")
 
 
 no_missed_events = 0
 no_events = 0
 unparseable_ftrace_lines = []
+# duty cycle of a sampled recording, see record_duty_cycle()
+sampling = None
+
+
+def data_file_shards(parser, file_path, start, end, shard_size, page_size=None):
+    # split [start, end) into newline (or page) aligned byte ranges
+    if shard_size <= 0 or end - start <= shard_size:
+        return [(parser, file_path, start, end)]
+    shards = []
+    with open(file_path, "rb") as file:
+        while start < end:
+            shard_end = start + shard_size
+            if page_size:
+                shard_end -= shard_end % page_size
+            elif shard_end < end:
+                file.seek(shard_end)
+                file.readline()
+                shard_end = file.tell()
+            shard_end = min(shard_end, end)
+            shards.append((parser, file_path, start, shard_end))
+            start = shard_end
+    return shards
+
+
+def data_file_codec(file_path):
+    # compressed recordings are detected by their magic bytes
+    with open(file_path, "rb") as file:
+        magic = file.read(6)
+    if magic.startswith(b"\x1f\x8b"):
+        return "gzip"
+    if magic.startswith(b"\xfd7zXZ\x00"):
+        return "lzma"
+    return None
+
+
+def open_data_file(file_path):
+    # compressed files are decompressed on the fly while reading
+    codec = data_file_codec(file_path)
+    if codec == "gzip":
+        return gzip.open(file_path, "rb")
+    if codec == "lzma":
+        return lzma.open(file_path, "rb")
+    return open(file_path, "rb")
+
+
+def data_file_end(file_path, file_size, page_size=None):
+    # offset behind the last complete line (or page), a recording which is
+    # still written may end with a partial one
+    if page_size:
+        return file_size - file_size % page_size
+    with open(file_path, "rb") as file:
+        end = file_size
+        while end > 0:
+            start = max(end - 65536, 0)
+            file.seek(start)
+            newline = file.read(end - start).rfind(b"\n")
+            if newline >= 0:
+                return start + newline + 1
+            end = start
+    return 0
+
+
+RECORD_META = None
+
+
+def recording_meta():
+    # meta data of per CPU recordings, loaded once per (worker) process
+    global RECORD_META
+    if RECORD_META is None:
+        with open(RECORD_META_FILE, "r") as fd:
+            RECORD_META = json.load(fd)
+    return RECORD_META
+
+
+def recording_format(aggregates=True):
+    # if a single file, a per CPU recording and/or an aggregate are present
+    # the most recent recording wins. Without aggregates the recorded
+    # trace data is used in any case
+    text_mtime = os.path.getmtime(RECORD_OUT_FILE) if os.path.exists(RECORD_OUT_FILE) else -1
+    meta_mtime = os.path.getmtime(RECORD_META_FILE) if os.path.exists(RECORD_META_FILE) else -1
+    aggregate_mtime = os.path.getmtime(AGGREGATE_FILE) if os.path.exists(AGGREGATE_FILE) else -1
+    if aggregates and aggregate_mtime > max(text_mtime, meta_mtime):
+        return "aggregate"
+    if meta_mtime > text_mtime:
+        return recording_meta().get("format", "raw")
+    return None
+
+
+def recording_sources():
+    # [(parser, file_path, page_size), ...] of the most recent recording
+    record_format = recording_format(aggregates=False)
+    if record_format is None:
+        return [(parse_text_range, RECORD_OUT_FILE, None)]
+    if record_format == "raw":
+        parser, output_file, page_size = parse_raw_range, RAW_CPU_FILE, raw_decoder().page_size
+    else:
+        parser, output_file, page_size = parse_text_range, TEXT_CPU_FILE, None
+    file_paths = [output_file.format(cpu) for cpu in recording_meta()["cpus"]]
+    return [(parser, file_path, page_size) for file_path in file_paths if get_file_size(file_path) > 0]
+
+
+def file_fingerprint(file_path, length):
+    # detects files rewritten in place by a new recording
+    with open(file_path, "rb") as file:
+        return zlib.crc32(file.read(min(length, 65536)))
+
 
+def file_state(file_path, offset):
+    stat = os.stat(file_path)
+    return {
+        "size": stat.st_size,
+        "mtime": stat.st_mtime_ns,
+        "inode": stat.st_ino,
+        "offset": offset,
+        "head": file_fingerprint(file_path, offset),
+    }
 
-def parse_data(map_db):
-    global no_missed_events, unparseable_ftrace_lines, no_events
+
+def cache_load(sources, tasks=False):
+    # returns the cached aggregate if it is still valid for the recording,
+    # a grown data file is fine: only the tail behind "offset" is parsed
     try:
-        with open(RECORD_OUT_FILE, "r") as file:
-            for line in file:
-                data, missed_events = parse_ftrace_line(line.strip())
-                if missed_events:
-                    no_missed_events += missed_events
-                    continue
-                if not data:
-                    continue
-                if not data and not missed_events:
-                    unparseable_ftrace_lines.add(line)
-                    continue
-                no_events += 1
-                GDB.add(data.parent, data.function, map_db)
+        with open(CACHE_FILE, "r") as fd:
+            cache = json.load(fd)
+    except (OSError, ValueError):
+        return None
+    if cache.get("version") != CACHE_VERSION:
+        return None
+    if tasks and not cache["tasks_complete"]:
+        return None
+    if sorted(cache["sources"]) != sorted(file_path for _, file_path, _ in sources):
+        return None
+    for _, file_path, _ in sources:
+        cached = cache["sources"][file_path]
+        stat = os.stat(file_path)
+        if stat.st_ino != cached["inode"] or stat.st_size < cached["size"]:
+            return None
+        if stat.st_size == cached["size"] and stat.st_mtime_ns != cached["mtime"]:
+            return None
+        # compressed streams cannot be parsed from an offset
+        if stat.st_size != cached["size"] and data_file_codec(file_path):
+            return None
+        if file_fingerprint(file_path, cached["offset"]) != cached["head"]:
+            return None
+    return cache
+
+
+def cache_save(sources_state, tasks):
+    # tasks: the per task calls are complete
+    try:
+        aggregate_write(CACHE_FILE, GDB, no_events, no_missed_events,
+                        version=CACHE_VERSION, sources=sources_state, tasks_complete=tasks)
+    except OSError as e:
+        print(f"cannot write cache {CACHE_FILE}: {e}")
+
+
+def parse_data_shard(shard):
+    # runs in a worker process, returns a partial aggregate which is
+    # merged into GDB by the parent
+    parser, file_path, start, end, window, tasks = shard
+    return parser(file_path, start, end, window, tasks)
+
+
+TEXT_PARSE_BLOCK = 4 * 1024 * 1024
+
+
+def parse_text_range(file_path, start, end, window=None, tasks=False):
+    # end is None for compressed files: parse the whole stream
+    parser = FtraceTextParser(window, tasks)
+    with open_data_file(file_path) as file:
+        file.seek(start)
+        remaining = float("inf") if end is None else end - start
+        while remaining > 0:
+            block = file.read(int(min(TEXT_PARSE_BLOCK, remaining)))
+            if not block:
+                break
+            remaining -= len(block)
+            parser.feed(block)
+    return parser.result()
+
+
+def raw_file_cpu(file_path):
+    # the CPU is given by the per CPU file, not by the events
+    for cpu in recording_meta()["cpus"]:
+        if os.path.basename(file_path) == RAW_CPU_FILE.format(cpu):
+            return cpu
+    return -1
+
+
+def parse_raw_range(file_path, start, end, window=None, tasks=False):
+    decoder = raw_decoder()
+    # same result as FtraceTextParser.result()
+    result = types.SimpleNamespace(edges=dict(), tasks=[], calls=[], task_calls=dict(), events=0,
+                                   missed_events=0, windows=dict())
+    task_ids = dict()
+    call_ids = dict()
+    cpu = raw_file_cpu(file_path)
+    end = float("inf") if end is None else end
+    with open_data_file(file_path) as file:
+        file.seek(start)
+        offset = start
+        while offset < end:
+            page = file.read(decoder.page_size)
+            if len(page) < decoder.page_size:
+                break
+            offset += len(page)
+            missed_events, events = decoder.decode_page(page)
+            result.missed_events += missed_events
+            for pid, ip, parent_ip, timestamp in events:
+                result.events += 1
+                key = (decoder.symbol(parent_ip), decoder.symbol(ip))
+                result.edges[key] = result.edges.get(key, 0) + 1
+                if tasks:
+                    task = task_ids.get(pid)
+                    if task is None:
+                        task = task_ids[pid] = len(result.tasks)
+                        result.tasks.append((decoder.task(pid), pid, cpu))
+                    call = call_ids.get(key)
+                    if call is None:
+                        call = call_ids[key] = len(result.calls)
+                        result.calls.append(key)
+                    task_key = task << 32 | call
+                    result.task_calls[task_key] = result.task_calls.get(task_key, 0) + 1
+                if window:
+                    key = (timestamp // window, key[1])
+                    result.windows[key] = result.windows.get(key, 0) + 1
+    return result
+
+
+def parse_data(map_db, jobs=1, use_cache=True, window=None, aggregate_path=None, tasks=False, aggregates=True):
+    # window: additionally count calls per window of n trace clock units,
+    # the cache holds no timestamps and is not loaded then.
+    # tasks: count calls per (task, pid, cpu) too, a cache without them is
+    # not loaded then.
+    # aggregates: a more recent AGGREGATE_FILE (record --aggregate or
+    # --mode profile) is loaded instead of the recording
+    # aggregate_path: load this aggregate instead of the local recording
+    # returns False if the data could not be read
+    global no_missed_events, unparseable_ftrace_lines, no_events, sampling
+    try:
+        if aggregate_path or (aggregates and recording_format() == "aggregate"):
+            aggregate_path = aggregate_path or AGGREGATE_FILE
+            aggregate = aggregate_read(aggregate_path)
+            GDB.load_aggregate(aggregate, map_db)
+            no_events += aggregate["events"]
+            no_missed_events += aggregate["missed_events"]
+            sampling = aggregate.get("sampling")
+            STATS.attach("bytes_read", get_file_size(aggregate_path))
+            print(f"loaded aggregate from {aggregate_path}")
+            if window:
+                print("aggregates contain no timestamps, no windows available")
+            return True
+        sources = recording_sources()
+        if recording_format(aggregates=False) is not None:
+            sampling = recording_meta().get("sampling")
+        cache = cache_load(sources, tasks) if use_cache and not window else None
+        if cache:
+            GDB.load_aggregate(cache, map_db)
+            no_events += cache["events"]
+            no_missed_events += cache["missed_events"]
+
+        ranges = []
+        sources_state = dict()
+        for parser, file_path, page_size in sources:
+            start = cache["sources"][file_path]["offset"] if cache else 0
+            codec = data_file_codec(file_path)
+            if codec:
+                end = os.path.getsize(file_path)
+            else:
+                end = data_file_end(file_path, os.path.getsize(file_path), page_size)
+            ranges.append((parser, file_path, start, end, page_size, codec))
+            sources_state[file_path] = file_state(file_path, end)
+        parse_size = sum(end - start for _, _, start, end, _, _ in ranges)
+        STATS.attach("bytes_read", parse_size)
+        if cache:
+            print(f"loaded cached aggregate from {CACHE_FILE}, {convert_size(parse_size)} new data to parse")
+
+        shards = []
+        for parser, file_path, start, end, page_size, codec in ranges:
+            if start >= end:
+                continue
+            if codec:
+                # decompressed as one stream, no sharding possible
+                shards.append((parser, file_path, 0, None, window, tasks))
+                continue
+            shard_size = parse_size // jobs + 1 if jobs > 1 else 0
+            if page_size and shard_size:
+                shard_size = max(shard_size - shard_size % page_size, page_size)
+            shards += [shard + (window, tasks) for shard in
+                       data_file_shards(parser, file_path, start, end, shard_size, page_size)]
+        if len(shards) > 1:
+            with multiprocessing.Pool(min(jobs, len(shards))) as pool:
+                results = pool.map(parse_data_shard, shards)
+        else:
+            results = [parse_data_shard(shard) for shard in shards]
+        # merge in file order, graph output stays identical to a sequential run
+        windows = dict()
+        for result in results:
+            no_events += result.events
+            no_missed_events += result.missed_events
+            for (caller, called), calls in result.edges.items():
+                GDB.add(caller, called, map_db, calls=calls)
+            GDB.add_task_calls(result, map_db)
+            for (window_no, function), calls in result.windows.items():
+                key = (window_no, GDB.ids[function])
+                windows[key] = windows.get(key, 0) + calls
+        GDB.set_windows(windows)
+        if use_cache and (shards or not cache):
+            cache_save(sources_state, tasks)
+        return True
 
-    except FileNotFoundError:
-        print(f"The file '{file_path}' does not exist.")
+    except FileNotFoundError as e:
+        print(f"The file '{e.filename}' does not exist.")
     except PermissionError:
         print(f"You don't have permission to read the file.")
     except Exception as e:
         print(f"An error occurred: {e}")
+    return False
+
+
+SYMBOL_INDEX_MAGIC = b"KMSYMIDX"
+SYMBOL_INDEX_VERSION = 1
+# magic, version, symbols, paths, symbol offsets, symbol path ids,
+# symbol names, path offsets, path names
+SYMBOL_INDEX_HEADER = struct.Struct("<8sIIIQQQQQ")
+
+
+def symbol_index_path(symbol_file_path):
+    return symbol_file_path + ".idx"
+
+
+def write_symbol_index(symbol_file_path):
+    # binary index of the text map: sorted symbols, each referencing one
+    # of the deduplicated paths. Like the text map, the last entry of a
+    # symbol wins
+    symbols = dict()
+    path_ids = dict()
+    with open(symbol_file_path, "r") as file:
+        for line in file:
+            symbol, filepath = line.strip().split("|")
+            symbols[symbol.encode()] = path_ids.setdefault(filepath, len(path_ids))
+    names = sorted(symbols)
+    paths = [filepath.encode() for filepath in path_ids]
+
+    def string_table(strings):
+        offsets = [0]
+        for string in strings:
+            offsets.append(offsets[-1] + len(string))
+        return struct.pack(f"<{len(offsets)}I", *offsets), b"".join(strings)
+
+    symbol_offsets, symbol_blob = string_table(names)
+    symbol_paths = struct.pack(f"<{len(names)}I", *(symbols[name] for name in names))
+    path_offsets, path_blob = string_table(paths)
+    sections = [symbol_offsets, symbol_paths, symbol_blob, path_offsets, path_blob]
+    positions = []
+    position = SYMBOL_INDEX_HEADER.size
+    for section in sections:
+        positions.append(position)
+        position += len(section)
+    index_path = symbol_index_path(symbol_file_path)
+    with open(index_path + ".tmp", "wb") as fd:
+        fd.write(SYMBOL_INDEX_HEADER.pack(SYMBOL_INDEX_MAGIC, SYMBOL_INDEX_VERSION,
+                                          len(names), len(paths), *positions))
+        for section in sections:
+            fd.write(section)
+    os.replace(index_path + ".tmp", index_path)
+    return index_path
+
+
+class SymbolIndex(object):
+    # read only, dict like view on a memory mapped symbol index. Nothing
+    # is loaded upfront, symbols are looked up by bisection on demand
+    def __init__(self, index_path):
+        with open(index_path, "rb") as fd:
+            self.mm = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.count, self.path_count, self.symbol_offsets, self.symbol_paths, \
+            self.symbol_blob, self.path_offsets, self.path_blob = SYMBOL_INDEX_HEADER.unpack_from(self.mm)
+        if magic != SYMBOL_INDEX_MAGIC or version != SYMBOL_INDEX_VERSION:
+            raise ValueError(f"{index_path}: not a symbol index of version {SYMBOL_INDEX_VERSION}")
+        self.u32 = struct.Struct("<I")
+        self.u32x2 = struct.Struct("<II")
+        self.paths = dict()
+
+    def _symbol(self, index):
+        start, end = self.u32x2.unpack_from(self.mm, self.symbol_offsets + index * 4)
+        return self.mm[self.symbol_blob + start:self.symbol_blob + end]
+
+    def _path(self, index):
+        path_id = self.u32.unpack_from(self.mm, self.symbol_paths + index * 4)[0]
+        filepath = self.paths.get(path_id)
+        if filepath is None:
+            start, end = self.u32x2.unpack_from(self.mm, self.path_offsets + path_id * 4)
+            filepath = self.mm[self.path_blob + start:self.path_blob + end].decode()
+            self.paths[path_id] = filepath
+        return filepath
+
+    def _find(self, symbol):
+        key = symbol.encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._symbol(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.count and self._symbol(low) == key:
+            return low
+        return None
+
+    def get(self, symbol, default=None):
+        index = self._find(symbol)
+        if index is None:
+            return default
+        return self._path(index)
+
+    def __getitem__(self, symbol):
+        index = self._find(symbol)
+        if index is None:
+            raise KeyError(symbol)
+        return self._path(index)
+
+    def __contains__(self, symbol):
+        return self._find(symbol) is not None
+
+    def __len__(self):
+        return self.count
+
+    def items(self):
+        for index in range(self.count):
+            yield self._symbol(index).decode(), self._path(index)
 
 
 def load_symbol_filepath_map(args):
@@ -469,6 +2340,16 @@ def load_symbol_filepath_map(args):
         return None
     if os.path.getsize(args.symbol_file_path) <= 0:
         return None
+    # prefer the binary index, (re)build it if missing or outdated
+    index_path = symbol_index_path(args.symbol_file_path)
+    try:
+        if not os.path.exists(index_path) or \
+                os.path.getmtime(index_path) < os.path.getmtime(args.symbol_file_path):
+            write_symbol_index(args.symbol_file_path)
+        map_db.symbol = SymbolIndex(index_path)
+        return map_db
+    except (OSError, ValueError) as e:
+        print(f"symbol index {index_path} not usable ({e}), loading {args.symbol_file_path}")
     with open(args.symbol_file_path, 'r') as file:
         for line in file:
             symbol, filepath = line.strip().split("|")
@@ -476,54 +2357,548 @@ def load_symbol_filepath_map(args):
     return map_db
 
 
+def sampling_scale(sampling, events):
+    # from the traced windows to the whole observation time, events lost
+    # in the ring buffers during the windows are accounted for as well
+    on_time = sum(window["on_time"] for window in sampling["windows"])
+    lost = sum(window["lost"] for window in sampling["windows"])
+    if not on_time or not events:
+        return 1.0
+    return sampling["observation_time"] / on_time * (events + lost) / events
+
+
 def visualize(args):
     print("Visualization mode - now generating visualization...")
-    map_db = load_symbol_filepath_map(args)
-    parse_data(map_db)
-    percent_lost = (no_missed_events / (no_missed_events + no_events)) * 100
+    with STATS.phase("load-symbol-map"):
+        map_db = load_symbol_filepath_map(args)
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    with STATS.phase("parse") as phase:
+        if not parse_data(map_db, jobs, use_cache=not args.no_cache, window=args.window,
+                      aggregate_path=args.aggregate, tasks=bool(args.comm or args.pid or args.cpu)):
+            return 1
+        phase["events"] = no_events
+    percent_lost = (no_missed_events / max(no_missed_events + no_events, 1)) * 100
     print(f"parsing completed, found {no_events} events")
     print(
         f"{no_missed_events} events missed during capturing process ({percent_lost:.2f}%)"
     )
-    graph_function_call_frequency(args)
-    visualize_data(args)
+    if sampling:
+        factor = sampling_scale(sampling, no_events)
+        GDB.scale(factor)
+        print(f"sampled recording, {len(sampling['windows'])} windows of {sampling['on_time']}s every "
+              f"{sampling['period']}s, counts scaled by {factor:.2f} to about {round(no_events * factor)} events")
+    if args.comm or args.pid or args.cpu:
+        if not GDB.task_calls:
+            print("recording contains no per task data (function profile), --comm, --pid and --cpu ignored")
+        else:
+            with STATS.phase("select-tasks"):
+                events = GDB.select_tasks(args.comm, args.pid, args.cpu)
+            print(f"{events} events of the selected tasks and CPUs")
+            if GDB.window_calls is not None:
+                print("note: --window counts are not restricted to the selected tasks and CPUs")
+    with STATS.phase("components"):
+        components = GDB.components()
+    print(f"{len(components)} connected call graph components, largest with {len(components[0]) if components else 0} functions")
+    if not GDB.edges:
+        with STATS.phase("filter"):
+            nodes = GDB.called_nodes(args, filter_calls=args.filter_execution_no)
+        with STATS.phase("plot"):
+            graph_function_call_frequency(args, nodes)
+        print("no calls recorded (function profile), no call graph generated")
+        return 0
+    with STATS.phase("filter"):
+        nodes, calls = GDB.subgraph(args, filter_calls=args.filter_execution_no)
+    with STATS.phase("plot"):
+        graph_function_call_frequency(args, nodes)
+        graph_function_call_windows(args, nodes)
+    visualize_data(args, nodes, calls)
     return 0
 
 
-def execute_command_incremental(command):
+class StackTree(object):
+    # call stacks as prefix tree: a shared prefix is stored once, memory
+    # grows with the distinct call paths, not with the recorded calls.
+    # Node 0 is the root, nodes are list indices, children are looked up
+    # by parent << 32 | function id like the network edges
+    def __init__(self):
+        self.ids = dict()
+        self.names = []
+        self.children = dict()
+        self.parent = [0]
+        self.function = [0]
+        self.calls = [0]
+
+    def function_id(self, name):
+        id = self.ids.get(name)
+        if id is None:
+            id = self.ids[name] = len(self.names)
+            self.names.append(name.decode(errors="replace"))
+        return id
+
+    def child(self, node, name):
+        key = node << 32 | self.function_id(name)
+        child = self.children.get(key)
+        if child is None:
+            child = self.children[key] = len(self.parent)
+            self.parent.append(node)
+            self.function.append(key & 0xFFFFFFFF)
+            self.calls.append(0)
+        return child
+
+    def path(self, node):
+        path = []
+        while node:
+            path.append(self.names[self.function[node]])
+            node = self.parent[node]
+        path.reverse()
+        return path
+
+    def paths(self):
+        # (call path, calls) of all nodes with calls, the calls of the
+        # callees are not included
+        for node, calls in enumerate(self.calls):
+            if calls:
+                yield self.path(node), calls
+
+    def write_folded(self, file_path):
+        # "func_a;func_b;func_c 42" per line, the input format of
+        # flamegraph.pl and speedscope
+        paths = 0
+        with open(file_path, "w") as fd:
+            for path, calls in self.paths():
+                fd.write(f"{';'.join(path)} {calls}\n")
+                paths += 1
+        return paths
+
+
+RE_GRAPH_SWITCH = re.compile(rb"^\s*(\d+)\)\s+\S+\s+=>\s+\S+")
+STACK_UNKNOWN = b"[unknown]"
+
+
+def parse_function_graph(file_path, tree):
+    #  3)               |  do_syscall_64() {
+    #  3)   0.541 us    |    rcu_all_qs();
+    #  3) + 12.31 us    |  }
+    # the indention after "|" is the call depth, a stack of tree nodes per
+    # CPU is cut to that depth on every line. Calls entered before the
+    # recording started show up as STACK_UNKNOWN.
+    stacks = dict()
+    events = missed_events = 0
+    with open_data_file(file_path) as fd:
+        for line in fd:
+            cpu_end = line.find(b")")
+            bar = line.rfind(b"|")
+            if cpu_end < 0 or bar < cpu_end:
+                if b"=>" in line and b"==>" not in line:
+                    # context switch, the stack belongs to the previous task
+                    match = RE_GRAPH_SWITCH.match(line)
+                    if match:
+                        stacks.pop(int(match.group(1)), None)
+                    continue
+                missed = parse_lost_event_lines(line.decode(errors="replace"))
+                if missed:
+                    missed_events += missed
+                continue
+            try:
+                cpu = int(line[:cpu_end])
+            except ValueError:
+                continue
+            text = line[bar + 1:].rstrip()
+            call = text.lstrip()
+            depth = max((len(text) - len(call) - 2) // 2, 0)
+            stack = stacks.setdefault(cpu, [])
+            if call.endswith(b"() {"):
+                name, enter = call[:-4], True
+            elif call.endswith(b"();"):
+                name, enter = call[:-3], False
+            elif call.startswith(b"}"):
+                del stack[depth:]
+                continue
+            else:
+                # comments, irq markers
+                continue
+            del stack[depth:]
+            while len(stack) < depth:
+                stack.append(tree.child(stack[-1] if stack else 0, STACK_UNKNOWN))
+            node = tree.child(stack[-1] if stack else 0, name)
+            tree.calls[node] += 1
+            events += 1
+            if enter:
+                stack.append(node)
+    return events, missed_events
+
+
+def stacks(args):
+    if not os.path.exists(args.input):
+        print(f"The file '{args.input}' does not exist, record with --mode graph first.")
+        return 1
+    tree = StackTree()
+    with STATS.phase("parse") as phase:
+        events, missed_events = parse_function_graph(args.input, tree)
+        phase["events"] = events
+        phase["bytes_read"] = get_file_size(args.input)
+    percent_lost = (missed_events / max(missed_events + events, 1)) * 100
+    print(f"parsing completed, found {events} calls, {len(tree.parent) - 1} distinct call paths")
+    print(f"{missed_events} events missed during capturing process ({percent_lost:.2f}%)")
+    with STATS.phase("write") as phase:
+        paths = tree.write_folded(args.output)
+        phase["bytes_written"] = get_file_size(args.output)
+    make_file_world_readable(args.output)
+    print(f"Wrote {paths} folded stacks to {args.output}")
+    if args.top:
+        for path, calls in heapq.nlargest(args.top, tree.paths(), key=lambda item: item[1]):
+            print(f"{calls:>12}  {';'.join(path)}")
+    return 0
+
+
+def aggregate_recording(args):
+    # parses the local recording once into a compact aggregate, e.g. to
+    # merge the recordings of several hosts
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    with STATS.phase("parse") as phase:
+        if not parse_data(None, jobs, use_cache=not args.no_cache, tasks=True, aggregates=False):
+            return 1
+        phase["events"] = no_events
+    if not GDB.names:
+        print("no data to aggregate")
+        return 1
+    with STATS.phase("write") as phase:
+        extra = {"sampling": sampling} if sampling else {}
+        aggregate_write(args.output, GDB, no_events, no_missed_events, compress=args.compress, **extra)
+        phase["bytes_written"] = get_file_size(args.output)
+    make_file_world_readable(args.output)
+    print(f"Wrote aggregate of {no_events} events, {len(GDB.edges)} distinct calls to {args.output}")
+    print(f"Aggregate filesize: {convert_size(get_file_size(args.output))}")
+    return 0
+
+
+def merge_aggregates(args):
+    # sums up aggregates (or subtracts all following ones from the first
+    # with --diff), one aggregate is loaded at a time: the cost depends on
+    # the distinct calls, not on the recorded events
+    network = Network()
+    events = missed_events = 0
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    with STATS.phase("merge") as phase:
+        if jobs > 1 and len(args.inputs) > 1:
+            pool = multiprocessing.Pool(min(jobs, len(args.inputs)))
+            aggregates = pool.imap(aggregate_read, args.inputs)
+        else:
+            pool = None
+            aggregates = map(aggregate_read, args.inputs)
+        try:
+            for index, (file_path, aggregate) in enumerate(zip(args.inputs, aggregates)):
+                sign = -1 if args.diff and index > 0 else 1
+                if aggregate.get("sampling"):
+                    print(f"note: {file_path} is a sampled recording, its counts are merged unscaled")
+                network.load_aggregate(aggregate, None, sign=sign)
+                events += sign * aggregate["events"]
+                missed_events += sign * aggregate["missed_events"]
+                phase["bytes_read"] = phase.get("bytes_read", 0) + get_file_size(file_path)
+                print(f"{'subtracted' if sign < 0 else 'added'} {file_path}, {len(aggregate['edges']) // 3} calls")
+        except (OSError, ValueError) as e:
+            print(f"cannot merge: {e}")
+            return 1
+        finally:
+            if pool:
+                pool.terminate()
+        if args.diff:
+            network.keep_increases()
+            # the totals follow the kept increases, one event per call
+            events, missed_events = sum(network.node_calls), 0
+    with STATS.phase("write") as phase:
+        aggregate_write(args.output, network, events, missed_events, compress=args.compress,
+                        merged={"mode": "diff" if args.diff else "sum", "inputs": args.inputs})
+        phase["bytes_written"] = get_file_size(args.output)
+    make_file_world_readable(args.output)
+    print(f"Wrote {'difference' if args.diff else 'sum'} of {len(args.inputs)} aggregates, "
+          f"{len(network.edges)} distinct calls to {args.output}")
+    return 0
+
+
+class RenderCache(object):
+    # least recently used renders, keyed by image format and filters
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.renders = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            data = self.renders.get(key)
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.renders.move_to_end(key)
+            return data
+
+    def put(self, key, data):
+        with self.lock:
+            self.renders[key] = data
+            self.renders.move_to_end(key)
+            while len(self.renders) > self.capacity:
+                self.renders.popitem(last=False)
+
+
+SERVE_FORMATS = {"svg": "image/svg+xml", "png": "image/png"}
+
+
+def serve_filter_args(args, query):
+    # query string into the filter namespace of visualize, parameters are
+    # named like the visualize options, e.g.
+    # /graph.svg?filter-filepath=net,kernel/sched&filter-execution-no=100
+    def value(name, convert=str, default=None):
+        values = query.get(name)
+        return convert(values[-1]) if values and values[-1] else default
+
+    def split(text):
+        return tuple(text.split(","))
+
+    filter_args = types.SimpleNamespace(
+        filter_filepath=value("filter-filepath", split),
+        exclude_filepath=value("exclude-filepath", split),
+        filter_execution_no=value("filter-execution-no", int, 0),
+        filter_component=value("filter-component", int),
+        top_edges=value("top-edges", int, 0),
+        collapse=value("collapse"),
+        layout=value("layout", default="auto"),
+        sfdp_threshold=args.sfdp_threshold,
+        export=None,
+        split_components=False,
+    )
+    if filter_args.collapse not in (None, "component", "directory"):
+        raise ValueError(f"unknown collapse {filter_args.collapse}")
+    if filter_args.layout not in ("auto", "dot", "sfdp"):
+        raise ValueError(f"unknown layout {filter_args.layout}")
+    return filter_args
+
+
+def serve_filter_key(filter_args):
+    return (filter_args.filter_filepath, filter_args.exclude_filepath, filter_args.filter_execution_no,
+            filter_args.filter_component, filter_args.top_edges, filter_args.collapse, filter_args.layout)
+
+
+def graph_render_data(source, image_format, prog):
+    # pool worker of serve, returns the image instead of writing a file
+    import pygraphviz as pgv
+    return graph_draw(pgv.AGraph(string=source), None, prog, image_format=image_format)
+
+
+class ServeHandler(object):
+    # request handler methods, combined with BaseHTTPRequestHandler in
+    # serve(). The loaded call graph and the render pool are attributes of
+    # the server
+    def do_GET(self):
+        import urllib.parse
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        try:
+            filter_args = serve_filter_args(self.server.args, query)
+            n = int(query.get("n", ["20"])[-1])
+        except ValueError as e:
+            self.reply(400, "text/plain", f"{e}\n".encode())
+            return
+        if url.path == "/":
+            self.reply(200, "text/plain", SERVE_USAGE.encode())
+        elif url.path in ("/nodes", "/edges", "/top"):
+            self.reply_json(self.query(url.path[1:], filter_args, n))
+        elif url.path.startswith("/graph."):
+            image_format = url.path[len("/graph."):]
+            if image_format not in SERVE_FORMATS:
+                self.reply(404, "text/plain", f"unknown image format {image_format}\n".encode())
+                return
+            try:
+                data = self.render(image_format, filter_args)
+            except Exception as e:
+                # e.g. pygraphviz missing or a graphviz error
+                print(f"render of {self.path} failed: {e}")
+                self.reply(500, "text/plain", f"render failed: {e}\n".encode())
+                return
+            self.reply(200, SERVE_FORMATS[image_format], data)
+        else:
+            self.reply(404, "text/plain", b"not found\n")
+
+    def query(self, name, filter_args, n):
+        # verdicts and components are cached in the network, one filter
+        # run at a time
+        with self.server.lock:
+            nodes, calls = GDB.subgraph(filter_args, filter_calls=filter_args.filter_execution_no)
+        if name == "edges":
+            return [{"caller": GDB.names[caller_id], "called": GDB.names[called_id], "calls": edge_calls}
+                    for caller_id, called_id, edge_calls in calls]
+        functions = [{"name": GDB.names[function_id], "filepath": GDB.filepaths[function_id],
+                      "executed": GDB.executed_no(function_id)} for function_id in nodes]
+        if name == "nodes":
+            return functions
+        calls = heapq.nlargest(n, calls, key=lambda call: call[2])
+        return {
+            "functions": heapq.nlargest(n, functions, key=lambda function: function["executed"]),
+            "calls": [{"caller": GDB.names[caller_id], "called": GDB.names[called_id], "calls": edge_calls}
+                      for caller_id, called_id, edge_calls in calls],
+        }
+
+    def render(self, image_format, filter_args):
+        key = (image_format,) + serve_filter_key(filter_args)
+        data = self.server.cache.get(key)
+        if data is not None:
+            return data
+        with self.server.lock:
+            nodes, calls = GDB.subgraph(filter_args, filter_calls=filter_args.filter_execution_no)
+            view = graph_view(filter_args, nodes, calls)
+            source = graph_build(view).string()
+        # the layout runs in the pool, other requests are served meanwhile
+        data = self.server.pool.apply(graph_render_data, (source, image_format,
+                                                          graph_layout_prog(filter_args, view)))
+        self.server.cache.put(key, data)
+        return data
+
+    def reply_json(self, data):
+        self.reply(200, "application/json", json.dumps(data).encode())
+
+    def reply(self, status, content_type, body):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+SERVE_USAGE = """kernel-magnifier serve
+
+/nodes        shown functions with filepath and calls
+/edges        shown calls
+/top?n=20     most frequent functions and calls
+/graph.svg    rendered call graph, also /graph.png
+
+filters, named like the visualize options:
+  filter-filepath, exclude-filepath, filter-execution-no,
+  filter-component, top-edges, collapse, layout
+
+e.g. /graph.svg?filter-filepath=net&top-edges=100
+"""
+
+
+def serve(args):
+    # loads the call graph once and answers filter queries from memory
+    print("Serve mode - loading the call graph...")
+    with STATS.phase("load-symbol-map"):
+        map_db = load_symbol_filepath_map(args)
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    with STATS.phase("parse") as phase:
+        if not parse_data(map_db, jobs, use_cache=not args.no_cache, aggregate_path=args.aggregate):
+            return 1
+        phase["events"] = no_events
+    if not GDB.names:
+        print("no data to serve")
+        return 1
+    if sampling:
+        GDB.scale(sampling_scale(sampling, no_events))
+    with STATS.phase("components"):
+        GDB.components()
+    print(f"loaded {no_events} events, {len(GDB.names)} functions, {len(GDB.edges)} distinct calls")
+    import http.server
+    handler = type("ServeHandler", (ServeHandler, http.server.BaseHTTPRequestHandler), dict())
+    server = http.server.ThreadingHTTPServer((args.host, args.port), handler)
+    server.args = args
+    server.lock = threading.Lock()
+    server.cache = RenderCache(args.cache_size)
+    # Ctrl-C stops the server, the render workers ignore it
+    server.pool = multiprocessing.Pool(jobs, initializer=signal.signal, initargs=(signal.SIGINT, signal.SIG_IGN))
+    print(f"serving on http://{args.host}:{server.server_address[1]}/")
     try:
-        process = subprocess.Popen(
-            command,
-            shell=True,
-            text=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        for line in process.stdout:
-            yield line.strip()
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Server stopped by the user.")
+    finally:
+        server.server_close()
+        server.pool.terminate()
+    print(f"{server.cache.hits} cached and {server.cache.misses} new renders")
+    return 0
 
-        return_code = process.wait()
-        if return_code != 0:
-            raise subprocess.CalledProcessError(return_code, command)
 
-    except subprocess.CalledProcessError as e:
-        print(f"Command \"{command}\" failed with return code {e.returncode}")
-        print(f"Error output: {e.stderr}")
+DWARFDUMP_CHUNK = 8 * 1024 * 1024
+SYMBOL_MAP_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "kernel-magnifier"
+)
+
+
+def elf_build_id(file_path):
+    # content of the .note.gnu.build-id section, None if not available
+    try:
+        with open(file_path, "rb") as fd:
+            ident = fd.read(16)
+            if ident[:4] != b"\x7fELF":
+                return None
+            endian = "<" if ident[5] == 1 else ">"
+            if ident[4] == 2:
+                header = struct.Struct(endian + "16xHHIQQQIHHHHHH")
+                section = struct.Struct(endian + "IIQQQQIIQQ")
+            else:
+                header = struct.Struct(endian + "16xHHIIIIIHHHHHH")
+                section = struct.Struct(endian + "IIIIIIIIII")
+            fd.seek(0)
+            fields = header.unpack(fd.read(header.size))
+            shoff, shentsize, shnum, shstrndx = fields[5], fields[10], fields[11], fields[12]
+            sections = []
+            for index in range(shnum):
+                fd.seek(shoff + index * shentsize)
+                sections.append(section.unpack(fd.read(section.size)))
+            # name, offset and size of each section
+            _, _, _, _, strtab_offset, strtab_size = sections[shstrndx][:6]
+            fd.seek(strtab_offset)
+            strtab = fd.read(strtab_size)
+            for name, _, _, _, offset, size in (entry[:6] for entry in sections):
+                if strtab[name:strtab.index(b"\0", name)] != b".note.gnu.build-id":
+                    continue
+                fd.seek(offset)
+                note = fd.read(size)
+                namesz, descsz, _ = struct.unpack_from(endian + "III", note)
+                desc_offset = 12 + (namesz + 3) // 4 * 4
+                return note[desc_offset:desc_offset + descsz].hex()
+    except (OSError, struct.error, ValueError, IndexError):
         return None
+    return None
 
-def mapping_sanitize_path(map_db):
-    limit = 200
-    analized = map_db[:200]
-    paths = [item[1] for item  in analized]
-    common_path = os.path.commonpath(paths)
-    modified_tuple_list = [(symbol, path[len(common_path):]) for symbol, path in map_db]
-    return modified_tuple_list
 
-def gen_mapping_db(args):
-    command = f"dwarfdump {args.debug_kernel_path}"
+def dwarfdump_chunks(debug_kernel_path):
+    # splits the dwarfdump output at compilation unit boundaries into
+    # chunks which can be parsed independently
+    try:
+        process = subprocess.Popen(["dwarfdump", debug_kernel_path], stdout=subprocess.PIPE)
+    except OSError as e:
+        # e.g. dwarfdump not installed
+        print(f"Command \"dwarfdump {debug_kernel_path}\" failed: {e}")
+        return
+    pending = b""
+    while True:
+        block = process.stdout.read(1024 * 1024)
+        if not block:
+            break
+        STATS.attach("bytes_read", len(block))
+        pending += block
+        if len(pending) < DWARFDUMP_CHUNK:
+            continue
+        split = pending.rfind(b"\nCOMPILE_UNIT<")
+        if split < 0 and len(pending) > 4 * DWARFDUMP_CHUNK:
+            split = pending.rfind(b"\n")
+        if split < 0:
+            continue
+        yield pending[:split + 1]
+        pending = pending[split + 1:]
+    if pending:
+        yield pending
+    return_code = process.wait()
+    if return_code != 0:
+        print(f"Command \"dwarfdump {debug_kernel_path}\" failed with return code {return_code}")
+
+
+def parse_dwarfdump_chunk(chunk):
     sym_name = sym_file = None
     map_db = []
-    for line in execute_command_incremental(command):
+    for line in chunk.decode(errors="replace").splitlines():
         if "DW_AT_name" in line:
             atoms = line.split()
             if len(atoms) != 2:
@@ -537,12 +2912,65 @@ def gen_mapping_db(args):
             if sym_name:
                 map_db.append([sym_name,sym_file])
                 sym_name = sym_file = None
-    map_db = mapping_sanitize_path(map_db)
+    return map_db
+
+
+def mapping_sanitize_path(map_db):
+    limit = 200
+    analized = map_db[:200]
+    paths = [item[1] for item  in analized]
+    common_path = os.path.commonpath(paths)
+    modified_tuple_list = [(symbol, path[len(common_path):]) for symbol, path in map_db]
+    return modified_tuple_list
+
+def gen_mapping_db(args):
     filename = "symbol-filepath.map"
-    with open(filename, "w") as fd:
-        for entry in map_db:
-            fd.write(f"{entry[0]}|{entry[1]}\n")
+    # the mapping depends only on the kernel build, generate it once
+    build_id = elf_build_id(args.debug_kernel_path)
+    cache_path = None
+    if build_id:
+        cache_path = os.path.join(SYMBOL_MAP_CACHE_DIR, f"symbol-filepath-{build_id}.map")
+    if cache_path and not args.no_cache and os.path.exists(cache_path):
+        with STATS.phase("copy-cached-map") as phase:
+            shutil.copyfile(cache_path, filename)
+            phase["bytes_written"] = get_file_size(filename)
+        print(f"wrote cached mapping table for build id {build_id} to {filename}")
+        with STATS.phase("write-symbol-index"):
+            print(f"wrote symbol index to {write_symbol_index(filename)}")
+        return 0
+
+    jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+    with STATS.phase("dwarfdump") as phase:
+        chunks = dwarfdump_chunks(args.debug_kernel_path)
+        map_db = []
+        if jobs > 1:
+            with multiprocessing.Pool(jobs) as pool:
+                for entries in pool.imap(parse_dwarfdump_chunk, chunks):
+                    map_db += entries
+        else:
+            for chunk in chunks:
+                map_db += parse_dwarfdump_chunk(chunk)
+        phase["events"] = len(map_db)
+    if not map_db:
+        # also the case if dwarfdump is missing or failed
+        print("no symbols found, mapping table not written")
+        return 1
+    with STATS.phase("write-map") as phase:
+        map_db = mapping_sanitize_path(map_db)
+        with open(filename, "w") as fd:
+            for entry in map_db:
+                fd.write(f"{entry[0]}|{entry[1]}\n")
+        phase["bytes_written"] = get_file_size(filename)
     print(f"wrote mapping table to {filename}")
+    with STATS.phase("write-symbol-index"):
+        print(f"wrote symbol index to {write_symbol_index(filename)}")
+    if cache_path:
+        try:
+            os.makedirs(SYMBOL_MAP_CACHE_DIR, exist_ok=True)
+            shutil.copyfile(filename, cache_path)
+        except OSError as e:
+            print(f"cannot cache mapping table in {SYMBOL_MAP_CACHE_DIR}: {e}")
+    return 0
 
 def uname_r():
     try:
@@ -567,6 +2995,145 @@ def parse_command_line_args():
     parser_record.add_argument(
         "--cpumask", type=str, default=None, help="cpumask, not hex, e.g. 0"
     )
+    parser_record.add_argument(
+        "--mode",
+        choices=["function", "profile", "graph"],
+        default="function",
+        help="function: trace every call, profile: in-kernel per function hit counters only, "
+        f"graph: function_graph tracer into {RECORD_GRAPH_FILE} for full call stacks (default: %(default)s)",
+    )
+    parser_record.add_argument(
+        "--filter-filepath",
+        type=str,
+        default=None,
+        help="trace only functions from these locations via set_ftrace_filter, can be a list; e.g kernel/sched,net",
+    )
+    parser_record.add_argument(
+        "--exclude-filepath",
+        type=str,
+        default=None,
+        help="do not trace functions from these locations via set_ftrace_notrace, can be a list",
+    )
+    parser_record.add_argument(
+        "--symbol-file-path",
+        type=str,
+        default="symbol-filepath.map",
+        help="path to symbol-filepath.map, required for filepath filters (default: %(default)s)",
+    )
+    parser_record.add_argument(
+        "--pid",
+        type=str,
+        default=None,
+        help="trace only these pids via set_ftrace_pid, can be a list; e.g. 1234,1235",
+    )
+    parser_record.add_argument(
+        "--comm",
+        type=str,
+        default=None,
+        help="trace only tasks with this name, can be a list; e.g. sshd,ksoftirqd/3",
+    )
+    parser_record.add_argument(
+        "--format",
+        choices=["text", "raw"],
+        default="text",
+        help="text from trace_pipe or binary pages from per_cpu trace_pipe_raw (default: %(default)s)",
+    )
+    parser_record.add_argument(
+        "--aggregate",
+        action="store_true",
+        help=f"parse while recording and write just the call graph aggregate to {AGGREGATE_FILE}",
+    )
+    parser_record.add_argument(
+        "--compress",
+        choices=["gzip", "lzma"],
+        default=None,
+        help="compress the recording in a dedicated writer thread",
+    )
+    parser_record.add_argument(
+        "--compress-level",
+        type=int,
+        default=None,
+        help="compression level, default is the fastest level of the codec",
+    )
+    parser_record.add_argument(
+        "--per-cpu",
+        action="store_true",
+        help="one concurrent reader and output file per CPU, always used for --format raw",
+    )
+    parser_record.add_argument(
+        "--sample-on",
+        type=float,
+        default=None,
+        help="trace only this many seconds every --sample-period, e.g. 0.05, visualize extrapolates "
+        "the counts; implies --per-cpu",
+    )
+    parser_record.add_argument(
+        "--sample-period",
+        type=float,
+        default=1.0,
+        help="sampling period in seconds for --sample-on (default: %(default)s)",
+    )
+
+    # live
+    parser_live = subparsers.add_parser("live", help="top-n functions and calls while tracing, nothing is recorded")
+    parser_live.set_defaults(mode="function", sample_on=None)
+    parser_live.add_argument(
+        "--record-time",
+        type=float,
+        default=0,
+        help="time to observe live data, 0 until interrupted (default: %(default)s)",
+    )
+    parser_live.add_argument(
+        "--interval",
+        type=float,
+        default=2.0,
+        help="refresh interval in seconds (default: %(default)s)",
+    )
+    parser_live.add_argument(
+        "--top",
+        type=int,
+        default=20,
+        help="number of functions and calls shown (default: %(default)s)",
+    )
+    parser_live.add_argument(
+        "--capacity",
+        type=int,
+        default=4096,
+        help="heavy hitter counters for functions and calls, bounds the memory (default: %(default)s)",
+    )
+    parser_live.add_argument(
+        "--cpumask", type=str, default=None, help="cpumask, not hex, e.g. 0"
+    )
+    parser_live.add_argument(
+        "--filter-filepath",
+        type=str,
+        default=None,
+        help="trace only functions from these locations via set_ftrace_filter, can be a list; e.g kernel/sched,net",
+    )
+    parser_live.add_argument(
+        "--exclude-filepath",
+        type=str,
+        default=None,
+        help="do not trace functions from these locations via set_ftrace_notrace, can be a list",
+    )
+    parser_live.add_argument(
+        "--symbol-file-path",
+        type=str,
+        default="symbol-filepath.map",
+        help="path to symbol-filepath.map, required for filepath filters (default: %(default)s)",
+    )
+    parser_live.add_argument(
+        "--pid",
+        type=str,
+        default=None,
+        help="trace only these pids via set_ftrace_pid, can be a list; e.g. 1234,1235",
+    )
+    parser_live.add_argument(
+        "--comm",
+        type=str,
+        default=None,
+        help="trace only tasks with this name, can be a list; e.g. sshd,ksoftirqd/3",
+    )
 
     # visualize
     parser_visualize = subparsers.add_parser("visualize", help="")
@@ -597,6 +3164,218 @@ def parse_command_line_args():
         default=None,
         help="filter functions based on locations, can be a list; e.g kernel/sched,net",
     )
+    parser_visualize.add_argument(
+        "--exclude-filepath",
+        type=str,
+        default=None,
+        help="hide functions based on locations, can be a list; e.g net/ipv6,net/netfilter",
+    )
+    parser_visualize.add_argument(
+        "--filter-component",
+        type=int,
+        default=None,
+        help="show only the n-th largest connected call graph component, 0 is the largest",
+    )
+    parser_visualize.add_argument(
+        "--aggregate",
+        type=str,
+        default=None,
+        help="visualize this aggregate, e.g. created by aggregate or merge, instead of the recording",
+    )
+    parser_visualize.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"ignore and do not write the parsed aggregate cache {CACHE_FILE}",
+    )
+    parser_visualize.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="parse data with n parallel processes, 0 for all CPUs (default: %(default)s)",
+    )
+    parser_visualize.add_argument(
+        "--comm",
+        type=str,
+        default=None,
+        help="show only calls of tasks with the given names, can be a list; e.g. ksoftirqd/3,iperf3",
+    )
+    parser_visualize.add_argument(
+        "--pid",
+        type=str,
+        default=None,
+        help="show only calls of the given task ids, can be a list",
+    )
+    parser_visualize.add_argument(
+        "--cpu",
+        type=str,
+        default=None,
+        help="show only calls on the given CPUs, can be a list",
+    )
+    parser_visualize.add_argument(
+        "--window",
+        type=int,
+        default=None,
+        help="plot calls of the hottest functions per window of n trace clock units (events for the counter clock)",
+    )
+    parser_visualize.add_argument(
+        "--top-edges",
+        type=int,
+        default=0,
+        help="show only the k most frequent calls, 0 for all (default: %(default)s)",
+    )
+    parser_visualize.add_argument(
+        "--collapse",
+        choices=["component", "directory"],
+        default=None,
+        help="collapse functions of a connected component or source directory into one node",
+    )
+    parser_visualize.add_argument(
+        "--layout",
+        choices=["auto", "dot", "sfdp"],
+        default="auto",
+        help="graphviz layout engine, auto switches to sfdp for large graphs (default: %(default)s)",
+    )
+    parser_visualize.add_argument(
+        "--sfdp-threshold",
+        type=int,
+        default=2000,
+        help="nodes plus edges above which auto layout uses sfdp (default: %(default)s)",
+    )
+    parser_visualize.add_argument(
+        "--export",
+        type=str,
+        default=None,
+        help="write the graph to foo.dot or foo.json without layout instead of rendering it",
+    )
+    parser_visualize.add_argument(
+        "--split-components",
+        action="store_true",
+        help="render each connected component into its own file, in parallel with --jobs",
+    )
+
+    # aggregate
+    parser_aggregate = subparsers.add_parser("aggregate", help="parse the recording into a compact aggregate")
+    parser_aggregate.add_argument(
+        "--output",
+        type=str,
+        default=EXPORT_AGGREGATE_FILE,
+        help="aggregate file (default: %(default)s)",
+    )
+    parser_aggregate.add_argument(
+        "--compress",
+        choices=["gzip", "lzma"],
+        default=None,
+        help="compress the aggregate",
+    )
+    parser_aggregate.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"ignore and do not write the parsed aggregate cache {CACHE_FILE}",
+    )
+    parser_aggregate.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="parse data with n parallel processes, 0 for all CPUs (default: %(default)s)",
+    )
+
+    # merge
+    parser_merge = subparsers.add_parser("merge", help="sum up or subtract aggregates, e.g. of several hosts")
+    parser_merge.add_argument("inputs", nargs="+", help="aggregate files")
+    parser_merge.add_argument(
+        "--output",
+        type=str,
+        default=MERGED_AGGREGATE_FILE,
+        help="merged aggregate file (default: %(default)s)",
+    )
+    parser_merge.add_argument(
+        "--diff",
+        action="store_true",
+        help="subtract all following aggregates from the first one instead of summing up",
+    )
+    parser_merge.add_argument(
+        "--compress",
+        choices=["gzip", "lzma"],
+        default=None,
+        help="compress the merged aggregate",
+    )
+    parser_merge.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="read aggregates with n parallel processes, 0 for all CPUs (default: %(default)s)",
+    )
+
+    # stacks
+    parser_stacks = subparsers.add_parser("stacks", help="call stacks of a --mode graph recording as folded stacks")
+    parser_stacks.add_argument(
+        "--input",
+        type=str,
+        default=RECORD_GRAPH_FILE,
+        help="function_graph recording (default: %(default)s)",
+    )
+    parser_stacks.add_argument(
+        "--output",
+        type=str,
+        default=STACKS_FILE,
+        help="folded stacks for flame graphs, e.g. flamegraph.pl (default: %(default)s)",
+    )
+    parser_stacks.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="print the n most frequent call paths, 0 for none (default: %(default)s)",
+    )
+
+    # serve
+    parser_serve = subparsers.add_parser("serve", help="filtered nodes, calls and renders over local HTTP")
+    parser_serve.add_argument(
+        "--host",
+        type=str,
+        default="127.0.0.1",
+        help="address to listen on (default: %(default)s)",
+    )
+    parser_serve.add_argument(
+        "--port",
+        type=int,
+        default=8000,
+        help="port to listen on, 0 for any free port (default: %(default)s)",
+    )
+    parser_serve.add_argument(
+        "--symbol-file-path",
+        type=str,
+        default="symbol-filepath.map",
+        help="path to symbol-filepath.map (default: %(default)s)",
+    )
+    parser_serve.add_argument(
+        "--aggregate",
+        type=str,
+        default=None,
+        help="serve this aggregate, e.g. created by aggregate or merge, instead of the recording",
+    )
+    parser_serve.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"ignore and do not write the parsed aggregate cache {CACHE_FILE}",
+    )
+    parser_serve.add_argument(
+        "--jobs",
+        type=int,
+        default=0,
+        help="parse data and render graphs with n parallel processes, 0 for all CPUs (default: %(default)s)",
+    )
+    parser_serve.add_argument(
+        "--cache-size",
+        type=int,
+        default=64,
+        help="rendered images kept in memory (default: %(default)s)",
+    )
+    parser_serve.add_argument(
+        "--sfdp-threshold",
+        type=int,
+        default=2000,
+        help="nodes plus edges above which auto layout uses sfdp (default: %(default)s)",
+    )
 
     # generate-symbol-map
     parser_symbol_generator = subparsers.add_parser("generate-symbol-map",
@@ -608,20 +3387,70 @@ def parse_command_line_args():
         default=f"/usr/lib/debug/boot/vmlinux-{uname_r()}",
         help="path to uncompressed, kernel with debug symbols (default: %(default)s)"
     )
+    parser_symbol_generator.add_argument(
+        "--jobs",
+        type=int,
+        default=0,
+        help="parse dwarfdump output with n parallel processes, 0 for all CPUs (default: %(default)s)",
+    )
+    parser_symbol_generator.add_argument(
+        "--no-cache",
+        action="store_true",
+        help=f"regenerate even if a mapping for this kernel build id exists in {SYMBOL_MAP_CACHE_DIR}",
+    )
+    for subparser in (parser_record, parser_live, parser_visualize, parser_aggregate, parser_merge,
+                      parser_stacks, parser_serve, parser_symbol_generator):
+        subparser.add_argument(
+            "--profile",
+            action="store_true",
+            help="print wall and CPU time per phase, rates, I/O and peak RSS as JSON",
+        )
+        subparser.add_argument(
+            "--stats-json",
+            type=str,
+            default=None,
+            help="write the --profile statistics to this file",
+        )
     return parser.parse_args()
 
 
 if __name__ == "__main__":
     args = parse_command_line_args()
     if args.subcommand == "record":
-        sys.exit(record(args))
+        for name in ("filter_filepath", "exclude_filepath", "pid", "comm"):
+            # convert into filter arrays
+            if getattr(args, name):
+                setattr(args, name, getattr(args, name).split(","))
+        exit_code = record(args)
+    elif args.subcommand == "live":
+        for name in ("filter_filepath", "exclude_filepath", "pid", "comm"):
+            if getattr(args, name):
+                setattr(args, name, getattr(args, name).split(","))
+        exit_code = live(args)
     elif args.subcommand == "visualize":
         if args.filter_filepath:
             # convert into filter array
             args.filter_filepath = args.filter_filepath.split(",")
-        sys.exit(visualize(args))
+        if args.exclude_filepath:
+            args.exclude_filepath = args.exclude_filepath.split(",")
+        if args.comm:
+            args.comm = args.comm.split(",")
+        for name in ("pid", "cpu"):
+            if getattr(args, name):
+                setattr(args, name, [int(value) for value in getattr(args, name).split(",")])
+        exit_code = visualize(args)
+    elif args.subcommand == "aggregate":
+        exit_code = aggregate_recording(args)
+    elif args.subcommand == "merge":
+        exit_code = merge_aggregates(args)
+    elif args.subcommand == "stacks":
+        exit_code = stacks(args)
+    elif args.subcommand == "serve":
+        exit_code = serve(args)
     elif args.subcommand == "generate-symbol-map":
-        gen_mapping_db(args)
+        exit_code = gen_mapping_db(args)
     else:
-        print("Please specify a subcommand (e.g., record, visualize or generate-symbol-map).")
+        print("Please specify a subcommand (e.g., record, live, visualize, aggregate, merge, stacks, serve or generate-symbol-map).")
         sys.exit(1)
+    STATS.report(args)
+    sys.exit(exit_code)
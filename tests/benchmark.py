@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+#
+# Benchmarks for the kernel-magnifier data path, based on synthetic
+# trace_pipe output. No ftrace, no root required:
+#
+#   ./benchmark.py --events 1000000 --output before.json
+#   ./benchmark.py --events 1000000 --compare before.json
+
+import argparse
+import contextlib
+import importlib.util
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+
+KERNEL_MAGNIFIER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "kernel-magnifier.py")
+
+TASK_NAMES = [
+    "<idle>", "kworker/u64:1", "kworker/3:1H", "ksoftirqd/3", "rcu_preempt",
+    "migration/2", "bash", "sshd: root@pts/0", "systemd-journal", "iperf3",
+]
+FLAGS = ["d..3.", "....1", "d.h2.", "..s1.", "dNs2.", "d..1."]
+SOURCE_FILES = [
+    "net/core/dev.c", "net/ipv4/tcp.c", "net/ipv4/tcp_input.c", "net/ipv6/route.c",
+    "drivers/net/ethernet/intel/e1000e/netdev.c", "kernel/sched/fair.c",
+    "kernel/sched/core.c", "kernel/sched/sched.h", "kernel/time/timer.c",
+    "mm/slub.c", "mm/page_alloc.c", "fs/read_write.c", "fs/ext4/inode.c",
+    "include/linux/skbuff.h", "arch/x86/entry/common.c",
+]
+
+
+def load_kernel_magnifier():
+    spec = importlib.util.spec_from_file_location("kernel_magnifier", KERNEL_MAGNIFIER)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def function_names(functions):
+    return [f"{random.choice(['__', '', 'do_', 'tcp_', 'sched_'])}func_{i}" for i in range(functions)]
+
+
+def generate_trace(file_path, events, functions, cpus, lost_ratio):
+    # trace_pipe like text output of the function tracer, function
+    # popularity follows a power law like on real systems
+    names = function_names(functions)
+    counter = 1207319054
+    with open(file_path, "w") as fd:
+        for _ in range(events):
+            counter += random.randint(1, 20)
+            cpu = random.randrange(cpus)
+            if random.random() < lost_ratio:
+                fd.write(f"CPU:{cpu} [LOST {random.randint(1, 5000)} EVENTS]\n")
+                continue
+            task = random.choice(TASK_NAMES)
+            pid = random.randint(0, 65535)
+            function = names[min(int(random.paretovariate(1.1)) - 1, functions - 1)]
+            parent = names[min(int(random.paretovariate(0.9)) - 1, functions - 1)]
+            fd.write(f"{task:>16}-{pid:<7} [{cpu:03d}] {random.choice(FLAGS)} {counter:>12}: {function} <-{parent}\n")
+    return names
+
+
+def generate_symbol_map(file_path, names):
+    with open(file_path, "w") as fd:
+        for name in names:
+            # some functions are not part of the debug info
+            if random.random() < 0.9:
+                fd.write(f"{name}|{random.choice(SOURCE_FILES)}\n")
+
+
+def measure(repeat, function):
+    # best of n runs, returns (seconds, items)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        items = function()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best[0]:
+            best = (elapsed, items)
+    return best
+
+
+def bench_parse_ftrace_line(km, data_path):
+    with open(data_path, "r") as fd:
+        lines = [line.strip() for line in fd]
+
+    def run():
+        for line in lines:
+            km.parse_ftrace_line(line)
+        return len(lines)
+    return run
+
+
+def bench_parse_data(km, data_path):
+    def run():
+        result = km.parse_text_range(data_path, 0, os.path.getsize(data_path))
+        return result.events
+    return run
+
+
+def bench_parse_data_tasks(km, data_path):
+    # with the per (task, pid, cpu) view, random pids make every line a new task
+    def run():
+        result = km.parse_text_range(data_path, 0, os.path.getsize(data_path), tasks=True)
+        return result.events
+    return run
+
+
+def bench_network_add(km, data_path, map_db):
+    events = []
+    with open(data_path, "r") as fd:
+        for line in fd:
+            data, _ = km.parse_ftrace_line(line.strip())
+            if data:
+                events.append((data.parent, data.function))
+
+    def run():
+        network = km.Network()
+        for parent, function in events:
+            network.add(parent, function, map_db)
+        return len(events)
+    return run
+
+
+def filter_args(filter_filepath):
+    return types.SimpleNamespace(
+        filter_filepath=filter_filepath,
+        exclude_filepath=None,
+        filter_component=None,
+        filter_execution_no=0,
+        top_edges=0,
+        collapse=None,
+        layout="dot",
+        export=None,
+        split_components=False,
+    )
+
+
+def bench_filter(km, network, filter_filepath):
+    args = filter_args(filter_filepath)
+
+    def run():
+        # new verdicts every run, like a new visualize invocation
+        network.verdicts_key = None
+        list(network.nodes(args))
+        list(network.calls(args))
+        return len(network.edges)
+    return run
+
+
+def bench_load_symbol_map(km, map_path):
+    args = types.SimpleNamespace(symbol_file_path=map_path)
+
+    def run():
+        return len(km.load_symbol_filepath_map(args).symbol)
+    return run
+
+
+def bench_graph_emission(km, network, image_path):
+    args = filter_args(["net"])
+    args.image_name = image_path
+    nodes, calls = network.subgraph(args)
+
+    def run():
+        km.visualize_data(args, nodes, calls)
+        return len(calls)
+    return run
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=os.path.dirname(KERNEL_MAGNIFIER),
+            stderr=subprocess.DEVNULL,
+            universal_newlines=True,
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline_path):
+    with open(baseline_path, "r") as fd:
+        baseline = json.load(fd)
+    print(f"\ncompared to {baseline_path} (commit {baseline.get('commit')}):")
+    for name, result in results["benchmarks"].items():
+        old = baseline["benchmarks"].get(name)
+        if not old or "seconds" not in old or "seconds" not in result:
+            continue
+        ratio = old["seconds"] / result["seconds"] if result["seconds"] else float("inf")
+        print(f"  {name:<24} {old['seconds']:9.4f}s -> {result['seconds']:9.4f}s  ({ratio:.2f}x)")
+
+
+def parse_command_line_args():
+    parser = argparse.ArgumentParser(description="kernel-magnifier benchmarks on synthetic trace data")
+    parser.add_argument("--events", type=int, default=200000, help="number of lines (default: %(default)s)")
+    parser.add_argument("--functions", type=int, default=5000, help="distinct functions (default: %(default)s)")
+    parser.add_argument("--cpus", type=int, default=16, help="number of CPUs (default: %(default)s)")
+    parser.add_argument("--lost-ratio", type=float, default=0.001, help="ratio of LOST lines (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=1, help="random seed (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per benchmark, best is taken (default: %(default)s)")
+    parser.add_argument("--output", type=str, default="benchmark.json", help="result file (default: %(default)s)")
+    parser.add_argument("--compare", type=str, default=None, help="previous result file to compare with")
+    parser.add_argument("--keep-data", type=str, default=None, help="directory to store the generated trace data")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_command_line_args()
+    random.seed(args.seed)
+    km = load_kernel_magnifier()
+    workdir = args.keep_data or tempfile.mkdtemp(prefix="kernel-magnifier-bench-")
+    os.makedirs(workdir, exist_ok=True)
+    data_path = os.path.join(workdir, "kernel-magnifier.data")
+    map_path = os.path.join(workdir, "symbol-filepath.map")
+
+    print(f"generating {args.events} events with {args.functions} functions on {args.cpus} CPUs in {workdir}")
+    names = generate_trace(data_path, args.events, args.functions, args.cpus, args.lost_ratio)
+    generate_symbol_map(map_path, names)
+    map_db = km.load_symbol_filepath_map(types.SimpleNamespace(symbol_file_path=map_path))
+    # visualize_data() works on the global network
+    network = km.GDB
+    result = km.parse_text_range(data_path, 0, os.path.getsize(data_path))
+    for (caller, called), calls in result.edges.items():
+        network.add(caller, called, map_db, calls=calls)
+
+    benchmarks = [
+        ("parse_ftrace_line", lambda: bench_parse_ftrace_line(km, data_path)),
+        ("parse_data", lambda: bench_parse_data(km, data_path)),
+        ("parse_data_tasks", lambda: bench_parse_data_tasks(km, data_path)),
+        ("network_add", lambda: bench_network_add(km, data_path, map_db)),
+        ("filter_nodes_calls", lambda: bench_filter(km, network, ["net", "kernel/sched"])),
+        ("load_symbol_map", lambda: bench_load_symbol_map(km, map_path)),
+        ("graph_emission", lambda: bench_graph_emission(km, network, os.path.join(workdir, "graph.dot"))),
+    ]
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "config": {
+            "events": args.events,
+            "functions": args.functions,
+            "cpus": args.cpus,
+            "lost_ratio": args.lost_ratio,
+            "seed": args.seed,
+            "repeat": args.repeat,
+        },
+        "benchmarks": dict(),
+    }
+    for name, setup in benchmarks:
+        try:
+            # parse_ftrace_line() reports unexpected lines, keep the output clean
+            with contextlib.redirect_stdout(io.StringIO()):
+                seconds, items = measure(args.repeat, setup())
+        except ImportError as e:
+            results["benchmarks"][name] = {"skipped": str(e)}
+            print(f"  {name:<24} skipped ({e})")
+            continue
+        results["benchmarks"][name] = {
+            "seconds": seconds,
+            "items": items,
+            "items_per_second": items / seconds if seconds else None,
+        }
+        print(f"  {name:<24} {seconds:9.4f}s  {items / seconds if seconds else 0:14.0f} items/s")
+
+    if not args.keep_data:
+        shutil.rmtree(workdir)
+    with open(args.output, "w") as fd:
+        json.dump(results, fd, indent=2)
+    print(f"results written to {args.output}")
+    if args.compare:
+        compare(results, args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())